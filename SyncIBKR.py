@@ -1,22 +1,35 @@
-import json
-import re
-from datetime import datetime
+import asyncio
+from datetime import datetime, time
 from typing import Optional
 
-import requests
-import yaml
-from ibflex import client, parser, FlexQueryResponse, BuySell, FlexStatement, Trade
+from ibflex import BuySell, Trade
+
+from activity import DAY_SECONDS, Activity, activity_matches, get_new_activities, parse_timestamp, timestamp_from_datetime, trade_ids
+from flex_cache import download_flex
+from flex_stream import FlexAccountData, parse_flex
+import metrics
+from ghostfolio_client import RANGE_MARGIN_DAYS, date_range_from
+from state import extract_trade_id, trade_ids_from_acts
+from symbols import SymbolResolver
+from sync_engine import BrokerSource, GhostfolioSink, SyncEngine
+from sync_settings import SyncSettings
 
 # Create logger
 import logging
 logger = logging.getLogger(__name__)
 
 
-def get_cash_amount_from_flex(account_statement: FlexStatement) -> dict:
+def get_cash_amount_from_flex(account_statement: FlexAccountData, per_currency: bool = False) -> dict:
     logger.info("Getting cash amount")
     base_currency = account_statement.AccountInformation.currency
     logger.info("Base currency: %s", base_currency)
     cash = {}
+    if per_currency:
+        for cash_report_currency in account_statement.CashReport:
+            if cash_report_currency.currency != "BASE_SUMMARY" and cash_report_currency.endingCash is not None:
+                cash[cash_report_currency.currency] = float(cash_report_currency.endingCash)
+        logger.info("Cash amounts: %s", cash)
+        return cash
     for cash_report_currency in account_statement.CashReport:
         if cash_report_currency.currency == "BASE_SUMMARY":
             try:
@@ -28,145 +41,86 @@ def get_cash_amount_from_flex(account_statement: FlexStatement) -> dict:
     return cash
 
 
-def generate_chunks(lst, n):
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
-
-
-def format_existing_act(act: dict, symbol_type: str = "symbol") -> dict:
-    symbol = act.get("SymbolProfile", {symbol_type: ""}).get(symbol_type)
-
-    if symbol is None or len(symbol) == 0:
-        logger.warning("Could not find nested symbol type %s for activity %s: %s",
-                       symbol_type, act["id"], act.get("SymbolProfile"))
-        symbol = act.get("symbol", "")
-
-    return {
-        "accountId": act["accountId"],
-        "date": act["date"][0:18],
-        "fee": abs(float(act["fee"])),
-        "quantity": abs(float(act["quantity"])),
-        "symbol": symbol,
-        "type": act["type"],
-        "unitPrice": act["unitPrice"]
-    }
-
+def reconcile_window(account_statement: FlexAccountData, activities: list) -> Optional[tuple]:
+    """
+    Epoch seconds [start, end) the report is complete for: its statement period widened to its
+    trades, or only the span of its trades when the period is unknown. None without either.
+    """
+    timestamps = [act.timestamp for act in activities]
+    if account_statement.fromDate is not None and account_statement.toDate is not None:
+        timestamps.append(timestamp_from_datetime(datetime.combine(account_statement.fromDate, time.min)))
+        timestamps.append(timestamp_from_datetime(datetime.combine(account_statement.toDate, time.min)) + DAY_SECONDS - 1)
+    if not timestamps:
+        return None
+    return min(timestamps), max(timestamps) + 1
 
-def format_new_act(act: dict, symbol_type: str = "symbol") -> dict:
-    return {
-        "accountId": act["accountId"],
-        "date": act["date"][0:18],
-        "fee": abs(float(act["fee"])),
-        "quantity": abs(float(act["quantity"])),
-        "symbol": act.get(symbol_type, ""),
-        "type": act["type"],
-        "unitPrice": act["unitPrice"]
-    }
 
-
-def is_act_present(new_act, existing_acts, synced_acts_ids: set):
-    # Precise comparison using the IBKR trade id
-    comment = new_act["comment"]
-    if comment is not None:
-        # Extract the tradeID from the comment using regular expressions
-        match = re.search(r"tradeID=(\d+)", comment)
-        if match:
-            trade_id = match.group(1)
-            if trade_id in synced_acts_ids:
-                return True
-
-    # Legacy comparison
-    for existing_act in existing_acts:
-        formatted_act = format_existing_act(existing_act, "figi")
-        formatted_new_act = format_new_act(new_act, "figi")
-        if formatted_act == formatted_new_act:
-            return True
-        formatted_act = format_existing_act(existing_act, "isin")
-        formatted_new_act = format_new_act(new_act)
-        if formatted_act == formatted_new_act:
-            return True
-        formatted_act = format_existing_act(existing_act)
-        formatted_new_act = format_new_act(new_act, "ibkrSymbol")
-        if formatted_act == formatted_new_act:
-            return True
-    return False
+# Ghostfolio figi/isin/symbol are compared against the activity figi/symbol/IBKR symbol
+IBKR_SYMBOL_MATCHES = (("figi", "figi"), ("isin", "symbol"), ("symbol", "broker_symbol"))
 
 
 def get_diff(old_acts, new_acts):
-    diff = []
-    synced_acts_ids = set()
-    for old_act in old_acts:
-        comment = old_act["comment"]
-        if comment is not None:
-            # Extract the tradeID from the comment using regular expressions
-            match = re.search(r"tradeID=(\d+)", comment)
-            if match:
-                trade_id = match.group(1)
-                synced_acts_ids.add(trade_id)
+    return get_new_activities(old_acts, new_acts, IBKR_SYMBOL_MATCHES)
 
-    for new_act in new_acts:
-        if not is_act_present(new_act, old_acts, synced_acts_ids):
-            del new_act["figi"]
-            del new_act["ibkrSymbol"]
-            diff.append(new_act)
-    return diff
 
-
-class SyncIBKR:
+class SyncIBKR(BrokerSource):
+    """IBKR Flex reports as the source of a sync, the engine does the Ghostfolio side."""
     #IBKRCATEGORY = "66b22c82-a96c-4e4f-aaf2-64b4ca41dda2"
-
-    def __init__(self, ghost_host, ibkrtoken, ibkrquery, ghost_key, ghost_token, ibkr_account_id, ghost_account_name, ghost_currency, ghost_ibkr_platform, mapping_file='mapping.yaml'):
-        self.account_id: Optional[str] = None
-        if ghost_token == "" and ghost_key != "":
-            self.ghost_token = self.create_ghost_token(ghost_host, ghost_key)
-        else:
-            self.ghost_token = ghost_token
-
-        if self.ghost_token is None or self.ghost_token == "":
-            logger.info("No bearer token provided, closing now")
-            raise Exception("No bearer token provided")
-
-        self.ghost_host = ghost_host
+    operation = "SYNCIBKR"
+    symbol_matches = IBKR_SYMBOL_MATCHES
+
+    def __init__(self, ghost_host, ibkrtoken, ibkrquery, ghost_key, ghost_token, ibkr_account_id, ghost_account_name, ghost_currency, ghost_ibkr_platform, mapping_file='mapping.yaml', state_dir: str = "", cash_per_currency: bool = False,
+                 settings: SyncSettings = None):
+        settings = settings or SyncSettings()
+        super().__init__(SymbolResolver(mapping_file, "ibkr", ghost_host, state_dir, settings.symbol_retry_after))
+        self.sink = GhostfolioSink(ghost_host, ghost_key, ghost_token, ghost_account_name, ghost_currency,
+                                   ghost_ibkr_platform, state_dir, settings)
+        self.settings = settings
+        self.engine = SyncEngine(self, self.sink)
         self.ibkr_account_id = ibkr_account_id
-        self.ghost_account_name = ghost_account_name
-        self.ghost_currency = ghost_currency
         self.ibkrtoken = ibkrtoken
         self.ibkrquery = ibkrquery
-        self.ibkrplatform = ghost_ibkr_platform
+        self.cash_per_currency = cash_per_currency
+        # Read by fetch and dropped once the activities are built
+        self.account_statement: Optional[FlexAccountData] = None
 
-        # Load the configuration file
-        with open(mapping_file, 'r') as file:
-            config = yaml.safe_load(file)
+    def sync_ibkr(self) -> bool:
+        return asyncio.run(self.engine.sync())
 
-        # Extract the symbol mapping from the configuration
-        self.symbol_mapping = config.get('symbol_mapping', {})
+    def fetch(self) -> bool:
+        self.account_statement = self.read_flex()
+        return self.account_statement is not None
 
-    def sync_ibkr(self):
-        logger.info("Fetching Query")
-        response = client.download(self.ibkrtoken, self.ibkrquery)
-        #logger.info("Parsing Query:\n%s", response)
-        query: FlexQueryResponse = parser.parse(response)
-        account_statement = self.get_account_flex_statement(query)
-        activities = []
-        date_format = "%Y-%m-%d %H:%M:%S"
-        data_source = "YAHOO"
+    def cash(self) -> dict:
+        return get_cash_amount_from_flex(self.account_statement, self.cash_per_currency)
+
+    def activities(self, account_id: str) -> list:
+        activities = self.activities_from_flex(self.account_statement, account_id)
+        self.account_statement = None
+        return activities
 
+    def read_flex(self) -> Optional[FlexAccountData]:
+        logger.info("Fetching Query")
+        with metrics.phase("flex_download"):
+            response = download_flex(self.ibkrtoken, self.ibkrquery, self.settings)
+        with metrics.phase("flex_parse"):
+            account_statement = parse_flex(response, self.ibkr_account_id, self.settings.flex_processes)
+        del response
+        if account_statement is None:
+            return None
         try:
-            self.ghost_currency = account_statement.AccountInformation.currency
+            self.sink.currency = account_statement.AccountInformation.currency
         except Exception as e:
             logger.error("Error getting currency from IBKR account statement: %s", e)
+        return account_statement
 
-        account_id = self.create_or_get_IBKR_accountId()
-        if account_id == "":
-            logger.info("Failed to retrieve account ID closing now")
-            return
-        self.set_cash_to_account(account_id, get_cash_amount_from_flex(account_statement))
+    def activities_from_flex(self, account_statement: FlexAccountData, account_id: str) -> list:
+        activities = []
+        data_source = "YAHOO"
         for trade in account_statement.Trades:
             if trade.openCloseIndicator is None:
                 logger.info("trade is not open or close (ignoring): %s", trade)
             elif trade.openCloseIndicator.CLOSE:
-                date = datetime.strptime(str(trade.dateTime), date_format)
-                iso_format = date.isoformat()
                 symbol = self.get_symbol_for_trade(trade, data_source)
 
                 if trade.buySell == BuySell.BUY:
@@ -177,26 +131,102 @@ class SyncIBKR:
                     logger.info("trade is not buy or sell (ignoring): %s", trade)
                     continue
 
-                activities.append({
-                    "accountId": account_id,
-                    "comment": f"tradeID={trade.tradeID}",
-                    "currency": trade.currency,
-                    "dataSource": data_source,
-                    "date": iso_format,
-                    "fee": abs(float(trade.ibCommission)),
-                    "quantity": abs(float(trade.quantity)),
-                    "symbol": symbol.replace(" ", "-"),
-                    "type": buysell,
-                    "unitPrice": float(trade.tradePrice),
-                    "figi": trade.figi,
-                    "ibkrSymbol": self.symbol_mapping[trade.symbol] if trade.symbol in self.symbol_mapping else trade.symbol
-                })
-
-        diff = get_diff(self.get_all_acts_for_account(), activities)
-        if len(diff) == 0:
-            logger.info("Nothing new to sync")
-        else:
-            self.import_act(diff)
+                activities.append(Activity(
+                    account_id=account_id,
+                    comment=f"tradeID={trade.tradeID}",
+                    currency=trade.currency,
+                    data_source=data_source,
+                    # ibflex already parsed dateTime, the seconds are read straight off it
+                    timestamp=timestamp_from_datetime(trade.dateTime),
+                    fee=float(trade.ibCommission),
+                    quantity=float(trade.quantity),
+                    symbol=symbol.replace(" ", "-"),
+                    type=buysell,
+                    unit_price=float(trade.tradePrice),
+                    figi=trade.figi,
+                    broker_symbol=self.symbols.resolve(trade.symbol)
+                ))
+        return activities
+
+    def reconcile_ibkr(self) -> bool:
+        """
+        Deletes the activities of the account the Flex report contradicts, those whose tradeID the
+        report doesn't hold, holds with other values or that are there twice, and imports the report
+        trades missing from Ghostfolio. Only activities with a tradeID dated within the report
+        period are looked at, whatever else the account holds is left alone.
+        """
+        self.symbols.refresh()
+        account_statement = self.read_flex()
+        if account_statement is None:
+            return False
+        with metrics.phase("ghostfolio_account"):
+            account_id = self.sink.find_account_id()
+        if account_id == "":
+            logger.info("No Ghostfolio account %s to reconcile, nothing was synced yet", self.sink.account_name)
+            return True
+        activities = self.activities_from_flex(account_statement, account_id)
+        metrics.count("activities_source", len(activities))
+        window = reconcile_window(account_statement, activities)
+        if window is None:
+            logger.info("Nothing to reconcile, the Flex report holds no trades and no period")
+            return True
+        start, end = window
+        date_range = date_range_from(start)
+        logger.info("Fetching Ghostfolio activities for range %s", date_range or "max")
+        with metrics.phase("ghostfolio_fetch"):
+            existing_acts = self.sink.get_activities(account_id, range=date_range)
+        metrics.count("activities_existing", len(existing_acts))
+
+        with metrics.phase("diff"):
+            source = {act.trade_id: act for act in activities if act.trade_id is not None}
+            stale, changed, duplicates = [], [], []
+            seen = set()
+            # Ghostfolio servers off UTC store dates shifted, an activity this close to the ends of the
+            # window may belong just outside of it, so it isn't deleted for missing from the report
+            margin = RANGE_MARGIN_DAYS * DAY_SECONDS
+            for act in existing_acts:
+                trade_id = extract_trade_id(act.get("comment"))
+                timestamp = parse_timestamp(act["date"])
+                if trade_id is None or not start <= timestamp < end:
+                    continue
+                if trade_id in seen:
+                    duplicates.append(act)
+                elif trade_id not in source:
+                    if start + margin <= timestamp < end - margin:
+                        stale.append(act)
+                elif not activity_matches(act, source[trade_id], IBKR_SYMBOL_MATCHES):
+                    changed.append(act)
+                seen.add(trade_id)
+        logger.info("Found %s activities missing from the report, %s differing from it and %s duplicates",
+                    len(stale), len(changed), len(duplicates))
+        metrics.count("activities_stale", len(stale))
+        metrics.count("activities_changed", len(changed))
+        metrics.count("activities_duplicate", len(duplicates))
+
+        to_delete = stale + changed + duplicates
+        with metrics.phase("delete"):
+            deleted = self.sink.delete_acts([act["id"] for act in to_delete])
+        metrics.count("activities_deleted", len(deleted))
+        metrics.count("activities_delete_failed", len(to_delete) - len(deleted))
+        ledger = self.sink.get_ledger(account_id)
+        if ledger is not None:
+            # A duplicate leaves its first copy behind, only its tradeID stays synced
+            ledger.remove(trade_ids_from_acts([act for act in stale + changed if act["id"] in deleted]))
+
+        # Activities whose delete failed still hold their tradeID, their trade isn't imported again
+        remaining = [act for act in existing_acts if act["id"] not in deleted]
+        with metrics.phase("diff"):
+            diff = get_diff(remaining, activities)
+        diff, _ = self.symbols.split_known_bad(diff)
+        metrics.count("activities_new", len(diff))
+        imported = True
+        if diff:
+            with metrics.phase("import"):
+                imported = self.engine.import_acts(diff)
+            if imported and ledger is not None:
+                ledger.add(trade_ids(diff))
+        logger.info("Reconciled: deleted %s of %s activities, imported %s", len(deleted), len(to_delete), len(diff))
+        return imported and len(deleted) == len(to_delete)
 
     def get_symbol_for_trade(self, trade: Trade, data_source: str):
         symbol = trade.symbol
@@ -204,242 +234,4 @@ class SyncIBKR:
             if trade.isin is not None and len(trade.isin) > 0:
                 symbol = trade.isin # ISIN provides better mapping
 
-        if symbol in self.symbol_mapping:
-            logger.info("Transformed symbol %s into %s", symbol, self.symbol_mapping[symbol])
-            symbol = self.symbol_mapping[symbol]
-        else:
-            logger.info("Symbol %s not found in mapping.", symbol)
-        return symbol
-
-    def create_ghost_token(self, ghost_host, ghost_key):
-        logger.info("No bearer token provided, fetching one")
-        token = {
-            'accessToken': ghost_key
-        }
-
-        url = f"{ghost_host}/api/v1/auth/anonymous"
-
-        payload = json.dumps(token)
-        headers = {
-            'Content-Type': 'application/json'
-        }
-        try:
-            response = requests.request("POST", url, headers=headers, data=payload)
-        except Exception as e:
-            logger.info(e)
-            return ""
-        if response.status_code == 201:
-            logger.info("Bearer token fetched")
-            return response.json()["authToken"]
-        logger.info("Failed fetching bearer token")
-        return ""
-
-    def set_cash_to_account(self, account_id, cash: dict):
-        if cash is None or len(cash) == 0:
-            logger.info("No cash set, no cash retrieved")
-            return False
-        for currency, amount in cash.items():
-            amount = {
-                "balance": amount,
-                "id": account_id,
-                "currency": currency,
-                "isExcluded": False,
-                "name": self.ghost_account_name,
-                "platformId": self.ibkrplatform
-            }
-            logger.info("Updating Cash for account " + account_id + ": " + json.dumps(amount))
-
-            url = f"{self.ghost_host}/api/v1/account/{account_id}"
-
-            payload = json.dumps(amount)
-            headers = {
-                'Authorization': f"Bearer {self.ghost_token}",
-                'Content-Type': 'application/json'
-            }
-            try:
-                response = requests.request("PUT", url, headers=headers, data=payload)
-            except Exception as e:
-                logger.info(e)
-                return
-            if response.status_code == 200:
-                logger.info(f"Updated Cash for account {response.json()['id']}")
-            else:
-                logger.info("Failed create: " + response.text)
-
-    def delete_act(self, act_id):
-        url = f"{self.ghost_host}/api/v1/order/{act_id}"
-
-        payload = {}
-        headers = {
-            'Authorization': f"Bearer {self.ghost_token}",
-        }
-        try:
-            response = requests.request("DELETE", url, headers=headers, data=payload)
-        except Exception as e:
-            logger.info(e)
-            return False
-
-        return response.status_code == 200
-
-    def import_act(self, bulk):
-        chunks = generate_chunks(sorted(bulk, key=lambda x: x["date"]), 10)
-        for acts in chunks:
-            logger.info("Adding activities:\n%s", json.dumps(acts, indent=4))
-
-            url = f"{self.ghost_host}/api/v1/import"
-            payload = json.dumps({"activities": acts})
-            headers = {
-                'Authorization': f"Bearer {self.ghost_token}",
-                'Content-Type': 'application/json'
-            }
-
-            try:
-                response = requests.request("POST", url, headers=headers, data=payload)
-            except Exception as e:
-                logger.info(e)
-                return False
-            if response.status_code == 201:
-                logger.info("Added activities. Response:\n%s", json.dumps(response.json(), indent=4))
-            else:
-                logger.info("Failed to create: " + response.text)
-            if response.status_code != 201:
-                return False
-        return True
-
-    def addAct(self, act):
-        url = f"{self.ghost_host}/api/v1/order"
-
-        payload = json.dumps(act)
-        headers = {
-            'Authorization': f"Bearer {self.ghost_token}",
-            'Content-Type': 'application/json'
-        }
-        logger.info("Adding activity: " + json.dumps(act))
-        try:
-            response = requests.request("POST", url, headers=headers, data=payload)
-        except Exception as e:
-            logger.info(e)
-            return False
-        if response.status_code == 201:
-            logger.info(f"created {response.json()['id']}")
-        else:
-            logger.info("Failed create: " + response.text)
-        return response.status_code == 201
-
-    def create_ibkr_account(self):
-        logger.info("Creating IBKR account")
-        account = {
-            "balance": 0,
-            "currency": self.ghost_currency,
-            "isExcluded": False,
-            "name": self.ghost_account_name,
-            "platformId": self.ibkrplatform
-        }
-
-        url = f"{self.ghost_host}/api/v1/account"
-
-        payload = json.dumps(account)
-        headers = {
-            'Authorization': f"Bearer {self.ghost_token}",
-            'Content-Type': 'application/json'
-        }
-        try:
-            response = requests.request("POST", url, headers=headers, data=payload)
-        except Exception as e:
-            logger.info(e)
-            return ""
-        if response.status_code == 201:
-            logger.info("IBKR account: " + response.json()["id"])
-            return response.json()["id"]
-        logger.info("Failed creating ")
-        return ""
-
-    def get_all_accounts(self):
-        logger.info("Finding all accounts")
-        url = f"{self.ghost_host}/api/v1/account"
-
-        payload = {}
-        headers = {
-            'Authorization': f"Bearer {self.ghost_token}",
-        }
-        try:
-            response = requests.request("GET", url, headers=headers, data=payload)
-        except Exception as e:
-            logger.info(e)
-            return []
-        if response.status_code == 200:
-            return response.json()['accounts']
-        else:
-            raise Exception(response)
-
-    def create_or_get_IBKR_accountId(self):
-        if self.account_id is not None:
-            return self.account_id
-
-        accounts = self.get_all_accounts()
-        logger.info("Accounts: %s", json.dumps(accounts, indent=4))
-        for account in accounts:
-            if account["name"] == self.ghost_account_name:
-                logger.info("IBKR account: %s", account["id"])
-                self.account_id = account["id"]
-                return account["id"]
-
-        self.account_id = self.create_ibkr_account()
-        return self.account_id
-
-    def delete_all_acts(self):
-        acts = self.get_all_acts_for_account()
-
-        if not acts:
-            logger.info("No activities to delete")
-            return True
-
-        url = f"{self.ghost_host}/api/v1/order"
-
-        payload = {}
-        headers = {
-            'Authorization': f"Bearer {self.ghost_token}",
-        }
-        try:
-            response = requests.request("DELETE",
-                                        url,
-                                        headers=headers,
-                                        params={"accounts": self.create_or_get_IBKR_accountId()},
-                                        data=payload)
-        except Exception as e:
-            logger.info(e)
-            return False
-
-        return response.status_code == 200
-
-    def get_all_acts_for_account(self, account_id: str = None, range: str = None, symbol: str = None):
-        if account_id is None:
-            account_id = self.create_or_get_IBKR_accountId()
-
-        url = f"{self.ghost_host}/api/v1/order"
-
-        payload = {}
-        headers = {
-            'Authorization': f"Bearer {self.ghost_token}",
-        }
-        try:
-            response = requests.request("GET",
-                                        url,
-                                        headers=headers,
-                                        params={"accounts": account_id,
-                                                "range": range,  # https://github.com/ghostfolio/ghostfolio/blob/main/libs/common/src/lib/types/date-range.type.ts
-                                                "symbol": symbol},
-                                        data=payload)
-        except Exception as e:
-            logger.info(e)
-            return []
-
-        if response.status_code == 200:
-            return response.json()['activities']
-        else:
-            return []
-
-    def get_account_flex_statement(self, query: FlexQueryResponse) -> FlexStatement:
-        return next(
-            (flex_statement for flex_statement in query.FlexStatements if flex_statement.accountId == self.ibkr_account_id),
-            None)
+        return self.symbols.resolve(symbol)
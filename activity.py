@@ -0,0 +1,167 @@
+import calendar
+import logging
+import math
+from datetime import datetime, timezone
+from typing import Iterable, Optional
+
+from state import extract_trade_id, symbol_trade_id, trade_ids_from_acts
+
+logger = logging.getLogger(__name__)
+
+# Dates used to be compared as date[:18], which matches them to the ten seconds
+DATE_KEY_SECONDS = 10
+
+DAY_SECONDS = 24 * 3600
+
+# Reconcile compares dates by day, a day either way since a Ghostfolio server off UTC stores them shifted
+MATCH_DATE_DAYS = 1
+# Relative difference of numbers reconcile still takes as equal, Ghostfolio doesn't store prices to the last digit
+MATCH_TOLERANCE = 1e-4
+
+
+def timestamp_from_datetime(value: datetime) -> int:
+    """Epoch seconds of the wall-clock time in value, any timezone is ignored like the string comparison did."""
+    return calendar.timegm(value.timetuple())
+
+
+def parse_timestamp(value: str) -> int:
+    return timestamp_from_datetime(datetime.fromisoformat(value[:19]))
+
+
+def format_timestamp(timestamp: int) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).replace(tzinfo=None).isoformat()
+
+
+def date_key(timestamp: int) -> int:
+    return timestamp - timestamp % DATE_KEY_SECONDS
+
+
+class Activity:
+    """
+    Trade coming from a broker, normalized once: the date is kept as epoch seconds and the
+    numbers as floats. `key` holds every compared field but the symbol, which depends on the
+    comparison made, see match_key.
+    """
+    __slots__ = ("account_id", "comment", "currency", "data_source", "timestamp", "fee", "quantity", "symbol",
+                 "type", "unit_price", "figi", "broker_symbol", "trade_id", "key")
+
+    def __init__(self, account_id: str, comment: Optional[str], currency: str, timestamp: int, fee: float,
+                 quantity: float, symbol: str, type: str, unit_price: float, data_source: Optional[str] = None,
+                 figi: Optional[str] = None, broker_symbol: Optional[str] = None):
+        self.account_id = account_id
+        self.comment = comment
+        self.currency = currency
+        self.data_source = data_source
+        self.timestamp = timestamp
+        self.fee = abs(fee)
+        self.quantity = abs(quantity)
+        self.symbol = symbol
+        self.type = type
+        self.unit_price = unit_price
+        self.figi = figi
+        self.broker_symbol = broker_symbol
+        self.trade_id = extract_trade_id(comment)
+        self.key = (account_id, date_key(timestamp), self.fee, self.quantity, type, unit_price)
+
+    @classmethod
+    def from_import(cls, act: dict) -> "Activity":
+        """Reverse of to_import, figi and brokerSymbol are read when present."""
+        return cls(account_id=act["accountId"], comment=act.get("comment"), currency=act["currency"],
+                   timestamp=parse_timestamp(act["date"]), fee=float(act["fee"]), quantity=float(act["quantity"]),
+                   symbol=act["symbol"], type=act["type"], unit_price=float(act["unitPrice"]),
+                   data_source=act.get("dataSource"), figi=act.get("figi"), broker_symbol=act.get("brokerSymbol"))
+
+    def for_account(self, account_id: str) -> "Activity":
+        return Activity(account_id, self.comment, self.currency, self.timestamp, self.fee, self.quantity, self.symbol,
+                        self.type, self.unit_price, self.data_source, self.figi, self.broker_symbol)
+
+    @property
+    def date(self) -> str:
+        return format_timestamp(self.timestamp)
+
+    def match_key(self, symbol: Optional[str]) -> tuple:
+        return self.key + (symbol,)
+
+    def to_import(self) -> dict:
+        """The activity as the Ghostfolio import endpoint expects it."""
+        act = {
+            "accountId": self.account_id,
+            "comment": self.comment,
+            "currency": self.currency,
+            "date": self.date,
+            "fee": self.fee,
+            "quantity": self.quantity,
+            "symbol": self.symbol,
+            "type": self.type,
+            "unitPrice": self.unit_price
+        }
+        if self.data_source is not None:
+            act["dataSource"] = self.data_source
+        return act
+
+    def __repr__(self) -> str:
+        return (f"Activity({self.type} {self.quantity} {self.symbol} @ {self.unit_price} {self.currency} "
+                f"on {self.date}, {self.comment})")
+
+
+def activity_trade_id(act: Activity, per_symbol: bool = False) -> Optional[str]:
+    """Trade id of act, scoped by its symbol when per_symbol is set, see symbol_trade_id."""
+    if act.trade_id is None or not per_symbol:
+        return act.trade_id
+    return symbol_trade_id(act.symbol, act.trade_id)
+
+
+def trade_ids(acts: Iterable[Activity], per_symbol: bool = False) -> set:
+    return {activity_trade_id(act, per_symbol) for act in acts} - {None}
+
+
+def ghostfolio_match_key(act: dict, symbol_type: str = "symbol") -> tuple:
+    """Match key of an activity returned by Ghostfolio, using symbol_type out of its SymbolProfile."""
+    symbol = act.get("SymbolProfile", {symbol_type: ""}).get(symbol_type)
+    if not symbol:
+        logger.warning("Could not find nested symbol type %s for activity %s: %s",
+                       symbol_type, act.get("id"), act.get("SymbolProfile"))
+        symbol = act.get("symbol", "")
+    return (act["accountId"], date_key(parse_timestamp(act["date"])), abs(float(act["fee"])),
+            abs(float(act["quantity"])), act["type"], act["unitPrice"], symbol)
+
+
+def activity_matches(existing_act: dict, new_act: Activity, symbol_matches: tuple) -> bool:
+    """
+    Whether an activity returned by Ghostfolio still holds the trade of new_act, both carrying the
+    same tradeID. Unlike the match keys of get_new_activities, dates are compared by day and numbers
+    within MATCH_TOLERANCE, so only a trade the broker really changed counts as different.
+    """
+    days = abs(parse_timestamp(existing_act["date"]) // DAY_SECONDS - new_act.timestamp // DAY_SECONDS)
+    if (days > MATCH_DATE_DAYS or existing_act["type"] != new_act.type
+            or not numbers_match(abs(float(existing_act["quantity"])), new_act.quantity)
+            or not numbers_match(abs(float(existing_act["fee"])), new_act.fee)
+            or not numbers_match(float(existing_act["unitPrice"]), new_act.unit_price)):
+        return False
+    return any(ghostfolio_match_key(existing_act, symbol_type)[-1] == getattr(new_act, attribute)
+               for symbol_type, attribute in symbol_matches)
+
+
+def numbers_match(a: float, b: float) -> bool:
+    return math.isclose(a, b, rel_tol=MATCH_TOLERANCE, abs_tol=MATCH_TOLERANCE)
+
+
+def get_new_activities(existing_acts: list, new_acts: Iterable[Activity], symbol_matches: tuple,
+                       per_symbol: bool = False) -> list:
+    """
+    The new activities not in Ghostfolio yet. An activity is present when its trade id is, or
+    when one of symbol_matches, pairs of (Ghostfolio symbol type, Activity attribute), matches.
+    Trade ids are compared along with the symbol when per_symbol is set.
+    """
+    synced_ids = trade_ids_from_acts(existing_acts, per_symbol)
+    index = {symbol_type: {ghostfolio_match_key(act, symbol_type) for act in existing_acts}
+             for symbol_type in {symbol_type for symbol_type, _ in symbol_matches}}
+    diff = []
+    for new_act in new_acts:
+        if activity_trade_id(new_act, per_symbol) in synced_ids:
+            continue
+        if any(new_act.match_key(getattr(new_act, attribute)) in index[symbol_type]
+               for symbol_type, attribute in symbol_matches):
+            continue
+        diff.append(new_act)
+    return diff
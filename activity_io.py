@@ -0,0 +1,129 @@
+import csv
+import json
+import logging
+import os
+import tempfile
+from typing import Iterable, Iterator, Optional
+
+from activity import Activity, parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("ndjson", "csv")
+
+# Written to CSV when no columns are asked for, enough to import the file again
+DEFAULT_CSV_COLUMNS = ("id", "date", "type", "SymbolProfile.symbol", "SymbolProfile.name", "SymbolProfile.dataSource",
+                       "SymbolProfile.currency", "quantity", "unitPrice", "fee", "value", "comment")
+
+
+def file_format(path: str, fmt: Optional[str] = None) -> str:
+    """fmt when given, otherwise guessed from the extension of path."""
+    fmt = (fmt or ("csv" if path.lower().endswith(".csv") else "ndjson")).lower()
+    if fmt not in FORMATS:
+        raise Exception(f"Unknown activity file format {fmt}, use one of {', '.join(FORMATS)}")
+    return fmt
+
+
+def column_value(act: dict, column: str):
+    """Value of column in act, nested fields are named with dots like SymbolProfile.symbol."""
+    value = act
+    for part in column.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def export_activities(acts: Iterable[dict], path: str, fmt: Optional[str] = None,
+                      columns: Optional[list] = None) -> int:
+    """
+    Writes Ghostfolio activities to path one row at a time, so acts can be a generator over
+    pages of a large account. NDJSON keeps whole activities unless columns are given.
+    """
+    fmt = file_format(path, fmt)
+    if fmt == "csv" and not columns:
+        columns = DEFAULT_CSV_COLUMNS
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    count = 0
+    try:
+        with os.fdopen(fd, "w", newline="") as file:
+            if fmt == "csv":
+                writer = csv.writer(file)
+                writer.writerow(columns)
+                for act in acts:
+                    writer.writerow([csv_value(column_value(act, column)) for column in columns])
+                    count += 1
+            else:
+                for act in acts:
+                    record = {column: column_value(act, column) for column in columns} if columns else act
+                    file.write(json.dumps(record) + "\n")
+                    count += 1
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    logger.info("Exported %s activities into %s", count, path)
+    return count
+
+
+def csv_value(value):
+    return json.dumps(value) if isinstance(value, (dict, list)) else value
+
+
+def read_records(path: str, fmt: Optional[str] = None) -> Iterator[dict]:
+    fmt = file_format(path, fmt)
+    with open(path, "r", newline="") as file:
+        if fmt == "csv":
+            yield from csv.DictReader(file)
+            return
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def record_value(record: dict, *columns: str):
+    """First non-empty of columns, read flat as written with column selection or nested as Ghostfolio returns them."""
+    for column in columns:
+        value = record[column] if column in record else column_value(record, column)
+        if value not in (None, ""):
+            return value
+    return None
+
+
+def activity_from_record(record: dict, account_id: str) -> Activity:
+    return Activity(account_id=account_id, comment=record_value(record, "comment"),
+                    currency=record_value(record, "currency", "SymbolProfile.currency"),
+                    timestamp=parse_timestamp(record_value(record, "date")),
+                    fee=float(record_value(record, "fee") or 0),
+                    quantity=float(record_value(record, "quantity") or 0),
+                    symbol=record_value(record, "symbol", "SymbolProfile.symbol"),
+                    type=record_value(record, "type"),
+                    unit_price=float(record_value(record, "unitPrice") or 0),
+                    data_source=record_value(record, "dataSource", "SymbolProfile.dataSource"))
+
+
+def read_activities(path: str, account_id: str, fmt: Optional[str] = None) -> Iterator[Activity]:
+    """The activities of an exported file, for account_id, read as they are consumed."""
+    for number, record in enumerate(read_records(path, fmt), 1):
+        try:
+            act = activity_from_record(record, account_id)
+        except (TypeError, ValueError) as e:
+            logger.warning("Skipping record %s of %s: %s", number, path, e)
+            continue
+        if not act.symbol or not act.type:
+            logger.warning("Skipping record %s of %s without symbol or type", number, path)
+            continue
+        yield act
+
+
+def batches(items: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,115 @@
+"""
+Benchmark get_diff against synthetic Ghostfolio histories.
+
+Run from the repository root:
+
+    python -m benchmarks.get_diff --sizes 1000,10000,100000
+
+For sizes up to --legacy-max the previous O(N*M) scan is timed as well and
+its result is checked against the indexed implementation.
+"""
+import argparse
+import logging
+import random
+import re
+import time
+
+from SyncIBKR import get_diff
+from benchmarks.synthetic import make_existing_act, make_new_act
+
+
+def format_existing_act(act: dict, symbol_type: str = "symbol") -> dict:
+    symbol = act.get("SymbolProfile", {symbol_type: ""}).get(symbol_type)
+    if symbol is None or len(symbol) == 0:
+        symbol = act.get("symbol", "")
+    return {
+        "accountId": act["accountId"],
+        "date": act["date"][0:18],
+        "fee": abs(float(act["fee"])),
+        "quantity": abs(float(act["quantity"])),
+        "symbol": symbol,
+        "type": act["type"],
+        "unitPrice": act["unitPrice"]
+    }
+
+
+def format_new_act(act: dict, symbol_type: str = "symbol") -> dict:
+    return {
+        "accountId": act["accountId"],
+        "date": act["date"][0:18],
+        "fee": abs(float(act["fee"])),
+        "quantity": abs(float(act["quantity"])),
+        "symbol": act.get(symbol_type, ""),
+        "type": act["type"],
+        "unitPrice": act["unitPrice"]
+    }
+
+
+def legacy_act(act) -> dict:
+    """Activity as the dict sync_ibkr used to build."""
+    return dict(act.to_import(), figi=act.figi, ibkrSymbol=act.broker_symbol)
+
+
+def legacy_get_diff(old_acts, new_acts):
+    """The pre-index implementation, kept here as the reference for equivalence."""
+    synced_acts_ids = {re.search(r"tradeID=(\d+)", act["comment"]).group(1)
+                       for act in old_acts
+                       if act["comment"] is not None and re.search(r"tradeID=(\d+)", act["comment"])}
+    diff = []
+    for new_act in new_acts:
+        match = re.search(r"tradeID=(\d+)", new_act["comment"] or "")
+        if match and match.group(1) in synced_acts_ids:
+            continue
+        present = False
+        for existing_act in old_acts:
+            if (format_existing_act(existing_act, "figi") == format_new_act(new_act, "figi")
+                    or format_existing_act(existing_act, "isin") == format_new_act(new_act)
+                    or format_existing_act(existing_act) == format_new_act(new_act, "ibkrSymbol")):
+                present = True
+                break
+        if not present:
+            del new_act["figi"]
+            del new_act["ibkrSymbol"]
+            diff.append(new_act)
+    return diff
+
+
+def build_dataset(size: int, seed: int = 42):
+    """`size` existing activities and `size` incoming trades, half of them new."""
+    old_acts = [make_existing_act(i) for i in range(size)]
+    new_acts = [make_new_act(i) for i in range(size // 2, size + size // 2)]
+    random.Random(seed).shuffle(new_acts)
+    return old_acts, new_acts
+
+
+def run(sizes, legacy_max: int):
+    print(f"{'activities':>10} | {'indexed (s)':>12} | {'legacy (s)':>12} | {'new':>8}")
+    for size in sizes:
+        old_acts, new_acts = build_dataset(size)
+        legacy_input = [legacy_act(act) for act in new_acts]
+
+        start = time.perf_counter()
+        diff = get_diff(old_acts, new_acts)
+        indexed_time = time.perf_counter() - start
+
+        legacy_time = "-"
+        if size <= legacy_max:
+            start = time.perf_counter()
+            legacy_diff = legacy_get_diff(old_acts, legacy_input)
+            legacy_time = f"{time.perf_counter() - start:12.3f}"
+            if legacy_diff != [act.to_import() for act in diff]:
+                raise AssertionError(f"Indexed and legacy diff differ for {size} activities")
+
+        print(f"{size:>10} | {indexed_time:12.3f} | {legacy_time:>12} | {len(diff):>8}")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument("--sizes", default="1000,10000,100000",
+                            help="Comma-separated numbers of existing activities")
+    arg_parser.add_argument("--legacy-max", type=int, default=2000,
+                            help="Largest size for which the legacy scan is also timed")
+    args = arg_parser.parse_args()
+    # Half of the synthetic activities carry no comment, silence the per-activity warnings
+    logging.basicConfig(level=logging.ERROR)
+    run([int(size) for size in args.sizes.split(",")], args.legacy_max)
@@ -0,0 +1,136 @@
+"""
+Offline benchmarks of the sync against the local Ghostfolio and Binance stand-in.
+
+Run from the repository root:
+
+    python -m benchmarks.run --sizes 1000,10000,100000 --latency 0.005 --output bench_results.json
+
+Each scenario runs against a fresh stub server. Timings, request counts and bytes
+served are written to --output as JSON so runs can be compared over time.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+from SyncIBKR import SyncIBKR, get_diff
+from benchmarks.get_diff import build_dataset
+from benchmarks.stub_server import StubState, start_stub_server
+from benchmarks.synthetic import (BINANCE_SYMBOLS, IBKR_ACCOUNT_ID, flex_report, make_existing_act,
+                                  make_new_act)
+from binanceSync import SyncBinance
+from pretty_print import pretty_print_table
+from sync_settings import SyncSettings
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAPPING_FILE = os.path.join(REPO_ROOT, "mapping.yaml")
+IBKR_ACCOUNT_NAME = "Interactive Brokers"
+BINANCE_ACCOUNT_NAME = "Binance"
+
+
+def make_ibkr_sync(host: str, settings: SyncSettings = None) -> SyncIBKR:
+    return SyncIBKR(host, "bench-token", "bench-query", "bench-key", "", IBKR_ACCOUNT_ID, IBKR_ACCOUNT_NAME,
+                    "USD", "", mapping_file=MAPPING_FILE, settings=settings)
+
+
+def scenario_get_diff(size: int, state: StubState, host: str, workdir: str) -> dict:
+    old_acts, new_acts = build_dataset(size)
+    start = time.perf_counter()
+    diff = get_diff(old_acts, new_acts)
+    return {"seconds": time.perf_counter() - start, "activities": len(diff)}
+
+
+def scenario_import_act(size: int, state: StubState, host: str, workdir: str) -> dict:
+    account_id = state.add_account(IBKR_ACCOUNT_NAME)
+    sync = make_ibkr_sync(host)
+    acts = [make_new_act(i, account_id) for i in range(size)]
+    start = time.perf_counter()
+    ok = sync.engine.import_acts(acts)
+    return {"seconds": time.perf_counter() - start, "activities": len(state.activities), "ok": ok}
+
+
+def scenario_sync_ibkr(size: int, state: StubState, host: str, workdir: str) -> dict:
+    """Half of the report is already in Ghostfolio, the other half gets imported."""
+    account_id = state.add_account(IBKR_ACCOUNT_NAME)
+    for i in range(size // 2):
+        state.add_activity(make_existing_act(i, account_id))
+    flex_file = os.path.join(workdir, f"flex-{size}.xml")
+    with open(flex_file, "wb") as file:
+        file.write(flex_report(size))
+    start = time.perf_counter()
+    make_ibkr_sync(host, SyncSettings(flex_file=flex_file)).sync_ibkr()
+    seconds = time.perf_counter() - start
+    return {"seconds": seconds, "activities": len(state.activities)}
+
+
+def scenario_sync_binance(size: int, state: StubState, host: str, workdir: str) -> dict:
+    state.binance_trades_per_symbol = size // len(BINANCE_SYMBOLS)
+    start = time.perf_counter()
+    sync = SyncBinance(host, "bench-key", "", BINANCE_ACCOUNT_NAME, "USDT", "", "bench-api-key", "bench-secret",
+                       binance_symbols=list(BINANCE_SYMBOLS), binance_base_url=host)
+    sync.sync_binance()
+    return {"seconds": time.perf_counter() - start, "activities": len(state.activities)}
+
+
+SCENARIOS = {
+    "get_diff": scenario_get_diff,
+    "import_act": scenario_import_act,
+    "sync_ibkr": scenario_sync_ibkr,
+    "sync_binance": scenario_sync_binance,
+}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def run(scenarios: list, sizes: list, latency: float) -> list:
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in scenarios:
+            for size in sizes:
+                state = StubState(latency)
+                server = start_stub_server(state)
+                try:
+                    result = SCENARIOS[name](size, state, f"http://127.0.0.1:{server.server_port}", workdir)
+                finally:
+                    server.shutdown()
+                    server.server_close()
+                result.update({"scenario": name, "size": size, **state.stats()})
+                print(f"{name} {size}: {result['seconds']:.2f}s, {result['total_requests']} requests", flush=True)
+                results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                            help=f"Comma-separated scenarios out of {', '.join(SCENARIOS)}")
+    arg_parser.add_argument("--sizes", default="1000,10000,100000", help="Comma-separated numbers of activities")
+    arg_parser.add_argument("--latency", type=float, default=0.005, help="Seconds added to every stub request")
+    arg_parser.add_argument("--output", default="bench_results.json", help="JSON file the results are written to")
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    results = run(args.scenarios.split(","), [int(size) for size in args.sizes.split(",")], args.latency)
+    report = {
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "latency": args.latency,
+        "results": results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(pretty_print_table(["SCENARIO", "SIZE", "SECONDS", "REQUESTS", "BYTES OUT", "ACTIVITIES"],
+                             [[r["scenario"], r["size"], f"{r['seconds']:.3f}", r["total_requests"],
+                               r["bytes_out"], r.get("activities", "")] for r in results]))
+    print(f"Results written to {args.output}")
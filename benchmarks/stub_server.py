@@ -0,0 +1,231 @@
+"""
+In-memory stand-in for the Ghostfolio and Binance endpoints used by the sync.
+
+Ghostfolio: POST /api/v1/auth/anonymous, GET/POST /api/v1/account, PUT /api/v1/account/{id},
+GET/DELETE /api/v1/order, DELETE /api/v1/order/{id}, POST /api/v1/order and POST /api/v1/import.
+Binance: GET /api/v3/account, GET /api/v3/exchangeInfo and GET /api/v3/myTrades (fromId/limit paging,
+weight headers).
+
+Every request waits `latency` seconds before being answered, request and byte counts
+per endpoint are kept in `stats`.
+"""
+import json
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import date, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from benchmarks.synthetic import BINANCE_SYMBOLS, binance_trade
+from ghostfolio_client import range_start_dates
+
+
+class StubState:
+    def __init__(self, latency: float = 0.0, binance_trades_per_symbol: int = 0):
+        self.latency = latency
+        self.lock = threading.RLock()
+        self.accounts = {}
+        self.activities = {}
+        self.binance_trades_per_symbol = binance_trades_per_symbol
+        self.binance_weight = 0
+        self.binance_window = 0
+        self.requests = Counter()
+        self.bytes_out = 0
+
+    def add_account(self, name: str, currency: str = "USD") -> str:
+        account_id = str(uuid.uuid4())
+        self.accounts[account_id] = {"id": account_id, "name": name, "currency": currency, "balance": 0,
+                                     "platformId": None, "isExcluded": False}
+        return account_id
+
+    def add_activity(self, act: dict):
+        act.setdefault("id", str(uuid.uuid4()))
+        self.activities[act["id"]] = act
+
+    def stats(self) -> dict:
+        return {"requests": dict(self.requests), "total_requests": sum(self.requests.values()),
+                "bytes_out": self.bytes_out}
+
+
+def activity_from_import(act: dict) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "accountId": act["accountId"],
+        "comment": act.get("comment"),
+        "date": act["date"][:19] + ".000Z",
+        "fee": act["fee"],
+        "quantity": act["quantity"],
+        "type": act["type"],
+        "unitPrice": act["unitPrice"],
+        "value": act["quantity"] * act["unitPrice"],
+        "SymbolProfile": {"symbol": act["symbol"], "isin": act["symbol"], "figi": None,
+                          "name": act["symbol"], "currency": act.get("currency")}
+    }
+
+
+def in_range(act: dict, date_range: str) -> bool:
+    if not date_range or date_range == "max":
+        return True
+    starts = dict(range_start_dates(date.today()))
+    if date_range not in starts:
+        return True
+    return datetime.fromisoformat(act["date"][:19]).date() >= starts[date_range]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    state: StubState = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status: int, body=None, headers: dict = None):
+        data = json.dumps(body if body is not None else {}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, str(value))
+        self.end_headers()
+        self.wfile.write(data)
+        with self.state.lock:
+            self.state.bytes_out += len(data)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def route(self, method: str):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        parts = url.path.strip("/").split("/")
+        endpoint = "/" + "/".join(parts[:3])
+        with self.state.lock:
+            self.state.requests[f"{method} {endpoint}"] += 1
+        time.sleep(self.state.latency)
+        body = self.read_json() if method in ("POST", "PUT") else None
+        handler = getattr(self, f"{method.lower()}_{'_'.join(parts[1:3])}", None)
+        if handler is None:
+            return self.reply(404, {"message": f"No stub for {method} {url.path}"})
+        return handler(parts, query, body)
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def do_PUT(self):
+        self.route("PUT")
+
+    def do_DELETE(self):
+        self.route("DELETE")
+
+    # Ghostfolio
+    def post_v1_auth(self, parts, query, body):
+        self.reply(201, {"authToken": "stub-token"})
+
+    def get_v1_account(self, parts, query, body):
+        with self.state.lock:
+            self.reply(200, {"accounts": list(self.state.accounts.values())})
+
+    def post_v1_account(self, parts, query, body):
+        with self.state.lock:
+            account_id = self.state.add_account(body["name"], body.get("currency", "USD"))
+            self.reply(201, self.state.accounts[account_id])
+
+    def put_v1_account(self, parts, query, body):
+        with self.state.lock:
+            account = self.state.accounts.get(parts[3])
+            if account is None:
+                return self.reply(404)
+            account.update(body)
+            self.reply(200, account)
+
+    def get_v1_order(self, parts, query, body):
+        accounts = set(query.get("accounts", "").split(",")) - {""}
+        with self.state.lock:
+            acts = [act for act in self.state.activities.values()
+                    if (not accounts or act["accountId"] in accounts) and in_range(act, query.get("range"))]
+        acts.sort(key=lambda act: act["date"])
+        skip = int(query.get("skip", 0))
+        take = int(query["take"]) if "take" in query else len(acts)
+        self.reply(200, {"activities": acts[skip:skip + take], "count": len(acts)})
+
+    def post_v1_order(self, parts, query, body):
+        act = activity_from_import(body)
+        with self.state.lock:
+            self.state.add_activity(act)
+        self.reply(201, act)
+
+    def delete_v1_order(self, parts, query, body):
+        with self.state.lock:
+            if len(parts) > 3:
+                if self.state.activities.pop(parts[3], None) is None:
+                    return self.reply(404)
+            else:
+                accounts = set(query.get("accounts", "").split(",")) - {""}
+                for act_id in [act_id for act_id, act in self.state.activities.items()
+                               if not accounts or act["accountId"] in accounts]:
+                    del self.state.activities[act_id]
+        self.reply(200)
+
+    def post_v1_import(self, parts, query, body):
+        acts = [activity_from_import(act) for act in body["activities"]]
+        with self.state.lock:
+            for act in acts:
+                self.state.add_activity(act)
+        self.reply(201, {"activities": acts})
+
+    # Binance
+    def binance_headers(self, weight: int) -> dict:
+        with self.state.lock:
+            window = int(time.time() // 60)
+            if window != self.state.binance_window:
+                self.state.binance_window = window
+                self.state.binance_weight = 0
+            self.state.binance_weight += weight
+            return {"X-MBX-USED-WEIGHT-1M": self.state.binance_weight}
+
+    def get_v3_account(self, parts, query, body):
+        balances = [{"asset": symbol[:-4], "free": "1", "locked": "0"} for symbol in BINANCE_SYMBOLS]
+        balances.append({"asset": "USDT", "free": "1000", "locked": "0"})
+        # Dust and delisted assets, no trades are fetched for these
+        balances.append({"asset": "XRP", "free": "0.00000000", "locked": "0.00000000"})
+        balances.append({"asset": "LUNC", "free": "5", "locked": "0"})
+        self.reply(200, {"balances": balances}, self.binance_headers(20))
+
+    def get_v3_exchangeInfo(self, parts, query, body):
+        symbols = [{"symbol": symbol, "status": "TRADING"} for symbol in BINANCE_SYMBOLS + ["XRPUSDT"]]
+        self.reply(200, {"symbols": symbols}, self.binance_headers(20))
+
+    def get_v3_myTrades(self, parts, query, body):
+        # Like Binance, every symbol numbers its trades from 0 so the same ids show up for every symbol
+        first = max(int(query.get("fromId", 0)), 0)
+        limit = min(int(query.get("limit", 500)), 1000)
+        last = min(first + limit, self.state.binance_trades_per_symbol)
+        trades = [dict(binance_trade(i), id=i) for i in range(first, last)]
+        self.reply(200, trades, self.binance_headers(20))
+
+
+def start_stub_server(state: StubState, port: int = 0) -> ThreadingHTTPServer:
+    handler = type("BoundStubHandler", (StubHandler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+
+    arg_parser = argparse.ArgumentParser(description="Serve the Ghostfolio and Binance stand-ins")
+    arg_parser.add_argument("--port", type=int, default=3333)
+    arg_parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    arg_parser.add_argument("--binance-trades", type=int, default=1000, help="myTrades per symbol")
+    args = arg_parser.parse_args()
+    stub = start_stub_server(StubState(args.latency, args.binance_trades), args.port)
+    print(f"Stub listening on http://127.0.0.1:{stub.server_port}")
+    threading.Event().wait()
@@ -0,0 +1,89 @@
+"""Synthetic Ghostfolio activities, IBKR Flex reports and Binance trades for the benchmarks."""
+from datetime import datetime, timedelta
+
+from activity import Activity, timestamp_from_datetime
+
+ACCOUNT_ID = "bench-account"
+IBKR_ACCOUNT_ID = "U0000001"
+START = datetime(2015, 1, 1, 9, 30)
+SYMBOLS = [("AAPL", "US0378331005", "BBG000B9XRY4"),
+           ("MSFT", "US5949181045", "BBG000BPH459"),
+           ("VWCE", "IE00BK5BQT80", "BBG00PDFJ4M6"),
+           ("CSPX", "IE00B5BMR087", "BBG000Q25W80")]
+BINANCE_SYMBOLS = ["BTCUSDT", "ETHUSDT", "BNBUSDT", "SOLUSDT"]
+
+
+def trade_date(i: int) -> datetime:
+    return START + timedelta(minutes=i)
+
+
+def make_existing_act(i: int, account_id: str = ACCOUNT_ID) -> dict:
+    """Activity i as Ghostfolio returns it, every other one without a tradeID comment."""
+    symbol, isin, figi = SYMBOLS[i % len(SYMBOLS)]
+    return {
+        "id": f"act-{i}",
+        "accountId": account_id,
+        "comment": f"tradeID={i}" if i % 2 == 0 else None,
+        "date": trade_date(i).isoformat() + ".000Z",
+        "fee": 1.0,
+        "quantity": float(i % 50 + 1),
+        "type": "BUY" if i % 3 else "SELL",
+        "unitPrice": 100.0 + i % 17,
+        "value": (100.0 + i % 17) * float(i % 50 + 1),
+        "SymbolProfile": {"symbol": isin, "isin": isin, "figi": figi, "name": symbol, "currency": "USD"}
+    }
+
+
+def make_new_act(i: int, account_id: str = ACCOUNT_ID) -> Activity:
+    """Trade i as sync_ibkr builds it from the Flex report."""
+    symbol, isin, figi = SYMBOLS[i % len(SYMBOLS)]
+    return Activity(
+        account_id=account_id,
+        comment=f"tradeID={i}",
+        currency="USD",
+        data_source="YAHOO",
+        timestamp=timestamp_from_datetime(trade_date(i)),
+        fee=1.0,
+        quantity=float(i % 50 + 1),
+        symbol=isin,
+        type="BUY" if i % 3 else "SELL",
+        unit_price=100.0 + i % 17,
+        figi=figi,
+        broker_symbol=symbol
+    )
+
+
+def flex_trade(i: int, account_id: str) -> str:
+    symbol, isin, figi = SYMBOLS[i % len(SYMBOLS)]
+    return (f'<Trade accountId="{account_id}" currency="USD" symbol="{symbol}" isin="{isin}" figi="{figi}" '
+            f'tradeID="{i}" dateTime="{trade_date(i).strftime("%Y%m%d;%H%M%S")}" quantity="{i % 50 + 1}" '
+            f'tradePrice="{100 + i % 17}" ibCommission="-1" buySell="{"BUY" if i % 3 else "SELL"}" '
+            f'openCloseIndicator="{"O" if i % 3 else "C"}" />')
+
+
+def flex_statement(account_id: str, trade_ids) -> str:
+    trades = "".join(flex_trade(i, account_id) for i in trade_ids)
+    return (f'<FlexStatement accountId="{account_id}" fromDate="20150101" toDate="20251231" period="Custom" '
+            f'whenGenerated="20251231;000000">'
+            f'<AccountInformation accountId="{account_id}" currency="USD" />'
+            f'<CashReport><CashReportCurrency accountId="{account_id}" currency="BASE_SUMMARY" endingCash="1000" />'
+            f'</CashReport><Trades>{trades}</Trades></FlexStatement>')
+
+
+def flex_report(size: int, other_accounts: int = 1) -> bytes:
+    """Flex report with size trades for IBKR_ACCOUNT_ID, plus other accounts of the same size."""
+    statements = [flex_statement(IBKR_ACCOUNT_ID, range(size))]
+    statements += [flex_statement(f"U{9000000 + n}", range(size)) for n in range(other_accounts)]
+    return (f'<FlexQueryResponse queryName="bench" type="AF"><FlexStatements count="{len(statements)}">'
+            f'{"".join(statements)}</FlexStatements></FlexQueryResponse>').encode("utf-8")
+
+
+def binance_trade(i: int) -> dict:
+    return {
+        "id": i,
+        "time": int(trade_date(i).timestamp() * 1000),
+        "isBuyer": bool(i % 3),
+        "commission": "0.001",
+        "qty": str(i % 50 + 1),
+        "price": str(100 + i % 17),
+    }
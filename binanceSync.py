@@ -1,114 +1,156 @@
-import json
-import re
+import asyncio
+import contextvars
+import threading
 import time
 import hmac
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Optional
 import requests
 import logging
+from requests.adapters import HTTPAdapter
+
+from activity import Activity, timestamp_from_datetime
+import metrics
+from state import ExchangeSymbolCache, TradeCursorStore
+from symbols import SymbolResolver
+from sync_engine import BrokerSource, GhostfolioSink, SyncEngine
+from sync_settings import SyncSettings
 
 logger = logging.getLogger(__name__)
 
+BINANCE_BASE_URL = "https://api.binance.com"
+BINANCE_TIMEOUT = 30
+# Request weight allowed per minute by Binance and the weight of the endpoints used here
+BINANCE_WEIGHT_LIMIT = 6000
+ACCOUNT_WEIGHT = 20
+MY_TRADES_WEIGHT = 20
+EXCHANGE_INFO_WEIGHT = 20
+# Seconds the symbols listed by exchangeInfo are used before they are fetched again
+EXCHANGE_INFO_TTL = 24 * 3600
+MY_TRADES_LIMIT = 1000
+RATE_LIMIT_RETRIES = 3
+
+# base url -> (symbols, fetched_at), exchangeInfo is the same for every account
+_exchange_symbols = {}
+_exchange_symbols_lock = threading.Lock()
+
+
+class BinanceWeightLimiter:
+    """
+    Keeps track of the request weight used in the current minute, as reported by the
+    X-MBX-USED-WEIGHT-1M header, and holds requests back before the limit is hit.
+    Weight is reserved before a request is sent so concurrent callers can't overshoot.
+    """
+
+    def __init__(self, weight_limit: int = BINANCE_WEIGHT_LIMIT, safety_margin: float = 0.9):
+        self.budget = int(weight_limit * safety_margin)
+        self.used_weight = 0
+        self.window = int(time.time() // 60)
+        self.blocked_until = 0.0
+        self._condition = threading.Condition()
+
+    def _roll_window(self):
+        window = int(time.time() // 60)
+        if window != self.window:
+            self.window = window
+            self.used_weight = 0
+
+    def acquire(self, weight: int):
+        logged = False
+        with self._condition:
+            while True:
+                now = time.time()
+                self._roll_window()
+                if now >= self.blocked_until and self.used_weight + weight <= self.budget:
+                    self.used_weight += weight
+                    return
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                else:
+                    wait = (self.window + 1) * 60 - now
+                wait = max(wait, 0.05)
+                if not logged:
+                    logger.info("Binance request weight %s/%s used, waiting %.1fs", self.used_weight, self.budget, wait)
+                    logged = True
+                self._condition.wait(wait)
+
+    def update(self, response: requests.Response):
+        used_weight = response.headers.get("X-MBX-USED-WEIGHT-1M") or response.headers.get("X-MBX-USED-WEIGHT")
+        with self._condition:
+            self._roll_window()
+            if used_weight is not None:
+                self.used_weight = max(self.used_weight, int(used_weight))
+            if response.status_code in (418, 429):
+                retry_after = int(response.headers.get("Retry-After", "60"))
+                logger.info("Binance rate limit hit (%s), backing off for %ss", response.status_code, retry_after)
+                self.blocked_until = max(self.blocked_until, time.time() + retry_after)
+            self._condition.notify_all()
+
+
+class SyncBinance(BrokerSource):
+    """Binance trades and balances as the source of a sync, the engine does the Ghostfolio side."""
+    operation = "SYNCBINANCE"
+    # Binance numbers the trades of every pair on its own
+    trade_ids_per_symbol = True
 
-def generate_chunks(lst, n):
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
-
-
-def format_existing_act(act: dict, symbol_type: str = "symbol") -> dict:
-    symbol = act.get("SymbolProfile", {symbol_type: ""}).get(symbol_type)
-    if not symbol:
-        logger.warning("Could not find nested symbol type %s for activity %s: %s",
-                       symbol_type, act.get("id"), act.get("SymbolProfile"))
-        symbol = act.get("symbol", "")
-    return {
-        "accountId": act["accountId"],
-        "date": act["date"][:18],
-        "fee": abs(float(act["fee"])),
-        "quantity": abs(float(act["quantity"])),
-        "symbol": symbol,
-        "type": act["type"],
-        "unitPrice": act["unitPrice"]
-    }
-
-
-def format_new_act(act: dict, symbol_type: str = "symbol") -> dict:
-    return {
-        "accountId": act["accountId"],
-        "date": act["date"][:18],
-        "fee": abs(float(act["fee"])),
-        "quantity": abs(float(act["quantity"])),
-        "symbol": act.get(symbol_type, ""),
-        "type": act["type"],
-        "unitPrice": act["unitPrice"]
-    }
-
-
-def is_act_present(new_act, existing_acts, synced_acts_ids: set):
-    comment = new_act.get("comment")
-    if comment:
-        match = re.search(r"tradeID=(\d+)", comment)
-        if match and match.group(1) in synced_acts_ids:
-            return True
-    # Compare only using the "symbol" field.
-    for existing_act in existing_acts:
-        if format_existing_act(existing_act, "symbol") == format_new_act(new_act, "symbol"):
-            return True
-    return False
-
-
-def get_diff(old_acts, new_acts):
-    diff = []
-    synced_acts_ids = set()
-    for old_act in old_acts:
-        comment = old_act.get("comment")
-        if comment:
-            match = re.search(r"tradeID=(\d+)", comment)
-            if match:
-                synced_acts_ids.add(match.group(1))
-    for new_act in new_acts:
-        if not is_act_present(new_act, old_acts, synced_acts_ids):
-            # Remove extra property not allowed by Ghostfolio.
-            new_act.pop("binanceSymbol", None)
-            diff.append(new_act)
-    return diff
-
-
-class SyncBinance:
     def __init__(self, ghost_host, ghost_key, ghost_token, ghost_account_name,
-                 ghost_currency, ghost_platform, binance_api_key, binance_api_secret, binance_symbols=None):
-        if ghost_token == "" and ghost_key:
-            self.ghost_token = self.create_ghost_token(ghost_host, ghost_key)
-        else:
-            self.ghost_token = ghost_token
-        if not self.ghost_token:
-            logger.info("No bearer token provided, closing now")
-            raise Exception("No bearer token provided")
-        self.ghost_host = ghost_host
-        self.ghost_account_name = ghost_account_name
+                 ghost_currency, ghost_platform, binance_api_key, binance_api_secret, binance_symbols=None, state_dir: str = "",
+                 binance_base_url: str = BINANCE_BASE_URL, binance_max_workers: int = 8,
+                 binance_weight_limit: int = BINANCE_WEIGHT_LIMIT, mapping_file: str = "mapping.yaml",
+                 exchange_info_ttl: float = EXCHANGE_INFO_TTL, settings: SyncSettings = None):
+        settings = settings or SyncSettings()
+        super().__init__(SymbolResolver(mapping_file, "binance", ghost_host, state_dir, settings.symbol_retry_after))
+        self.sink = GhostfolioSink(ghost_host, ghost_key, ghost_token, ghost_account_name, ghost_currency,
+                                   ghost_platform, state_dir, settings)
+        self.engine = SyncEngine(self, self.sink)
         self.ghost_currency = ghost_currency  # e.g. "USDT"
-        self.ghost_platform = ghost_platform
         self.binance_api_key = binance_api_key
         self.binance_api_secret = binance_api_secret
+        self.binance_base_url = binance_base_url.rstrip("/")
+        self.binance_max_workers = max(1, binance_max_workers)
+        self.binance = requests.Session()
+        self.binance.mount("https://", HTTPAdapter(pool_maxsize=self.binance_max_workers))
+        self.binance.mount("http://", HTTPAdapter(pool_maxsize=self.binance_max_workers))
+        self.limiter = BinanceWeightLimiter(binance_weight_limit)
         # Optional list of symbols; if not provided, the script will derive symbols from account balances.
         self.binance_symbols = binance_symbols if binance_symbols is not None else []
-        self.symbol_mapping = {}  # We assume symbols match on both platforms.
-        self.account_id: Optional[str] = None
-
-    def create_ghost_token(self, ghost_host, ghost_key):
-        token = {'accessToken': ghost_key}
-        url = f"{ghost_host}/api/v1/auth/anonymous"
-        payload = json.dumps(token)
-        headers = {'Content-Type': 'application/json'}
-        try:
-            response = requests.post(url, headers=headers, data=payload)
-        except Exception as e:
-            logger.info(e)
-            return ""
-        if response.status_code == 201:
-            return response.json().get("authToken", "")
-        return ""
+        self.state_dir = state_dir
+        self.exchange_info_ttl = exchange_info_ttl
+        # Account snapshot of the current run, read once by fetch for the cash and the symbols
+        self.account_info: Optional[dict] = None
+        # Pairs trades were seen for, the stored cursors remember them across processes
+        self.traded_symbols = set()
+        self.pending_cursors = {}
+
+    def sync_binance(self) -> bool:
+        return asyncio.run(self.engine.sync())
+
+    def fetch(self) -> bool:
+        with metrics.phase("binance_account"):
+            self.account_info = self.get_binance_account_info()
+        if self.account_info is None:
+            logger.info("No account info retrieved from Binance")
+            return False
+        return True
+
+    def cash(self) -> dict:
+        return self.get_cash_amount_from_binance(self.account_info)
+
+    def activities(self, account_id: str) -> list:
+        with metrics.phase("binance_trades"):
+            trades = self.get_binance_trades(account_id)
+        self.account_info = None
+        return trades
+
+    def held_back(self, acts: list):
+        for trade in acts:
+            # Fetch these trades again once the symbol is retried
+            self.pending_cursors.pop(trade.broker_symbol, None)
+
+    def synced(self, account_id: str):
+        self.save_cursors(account_id)
 
     def sign_params(self, params: dict) -> dict:
         params['timestamp'] = int(time.time() * 1000)
@@ -119,14 +161,24 @@ class SyncBinance:
         params['signature'] = signature
         return params
 
+    def binance_get(self, endpoint: str, params: dict, weight: int, signed: bool = True):
+        """GET against Binance, signed unless told otherwise, waiting for request weight and retrying when rate limited."""
+        headers = {'X-MBX-APIKEY': self.binance_api_key} if signed else {}
+        response = None
+        for _ in range(RATE_LIMIT_RETRIES):
+            self.limiter.acquire(weight)
+            response = self.binance.get(self.binance_base_url + endpoint, headers=headers,
+                                        params=self.sign_params(dict(params)) if signed else params,
+                                        timeout=BINANCE_TIMEOUT)
+            self.limiter.update(response)
+            metrics.count_response("binance", response)
+            if response.status_code not in (418, 429):
+                break
+        return response
+
     def get_binance_account_info(self):
-        base_url = "https://api.binance.com"
-        endpoint = "/api/v3/account"
-        params = {}
-        signed_params = self.sign_params(params)
-        headers = {'X-MBX-APIKEY': self.binance_api_key}
         try:
-            response = requests.get(base_url + endpoint, headers=headers, params=signed_params)
+            response = self.binance_get("/api/v3/account", {}, ACCOUNT_WEIGHT)
         except Exception as e:
             logger.info(e)
             return None
@@ -144,198 +196,141 @@ class SyncBinance:
                     logger.info(e)
         return {}
 
-    def derive_symbols_from_account(self, account_info):
+    def get_exchange_symbols(self) -> Optional[set]:
+        """Symbols Binance lists, from memory, the state dir or exchangeInfo. None when unknown."""
+        with _exchange_symbols_lock:
+            cached = _exchange_symbols.get(self.binance_base_url)
+            cache = ExchangeSymbolCache(self.state_dir, self.binance_base_url) if self.state_dir else None
+            if cached is None and cache is not None:
+                cached = cache.load()
+            if cached is not None and time.time() - cached[1] < self.exchange_info_ttl:
+                _exchange_symbols[self.binance_base_url] = cached
+                return cached[0]
+            logger.info("Fetching Binance exchange info")
+            try:
+                response = self.binance_get("/api/v3/exchangeInfo", {}, EXCHANGE_INFO_WEIGHT, signed=False)
+            except Exception as e:
+                logger.info(e)
+                response = None
+            if response is None or response.status_code != 200:
+                logger.info("Failed to get Binance exchange info: %s", response.text if response is not None else "")
+                # An outdated list beats checking nothing
+                return cached[0] if cached is not None else None
+            symbols = {symbol["symbol"] for symbol in response.json().get("symbols", [])}
+            _exchange_symbols[self.binance_base_url] = (symbols, time.time())
+            if cache is not None:
+                cache.save(symbols, time.time())
+            return symbols
+
+    def derive_symbols_from_account(self, account_info, traded_symbols=()):
         """
         Derive trading pairs from account balances.
         Assumes that for each asset (except the base/quote currency),
-        the trading pair is asset+ghost_currency.
+        the trading pair is asset+ghost_currency. Only assets with a free or locked balance
+        count and pairs Binance doesn't list are dropped, pairs traded before are always kept
+        so selling a whole position still shows up.
         """
-        symbols = []
+        symbols = set()
         for balance in account_info.get("balances", []):
             asset = balance.get("asset")
-            if asset and asset != self.ghost_currency:
-                symbol = asset + self.ghost_currency
-                symbols.append(symbol)
-        return symbols
-
-    def get_binance_trades(self):
-        base_url = "https://api.binance.com"
-        endpoint = "/api/v3/myTrades"
+            if not asset or asset == self.ghost_currency:
+                continue
+            try:
+                held = float(balance.get("free", "0")) + float(balance.get("locked", "0"))
+            except (TypeError, ValueError):
+                continue
+            if held > 0:
+                symbols.add(asset + self.ghost_currency)
+        exchange_symbols = self.get_exchange_symbols()
+        if exchange_symbols is not None:
+            unlisted = symbols - exchange_symbols
+            if unlisted:
+                logger.info("Skipping pairs Binance doesn't list: %s", ", ".join(sorted(unlisted)))
+            symbols &= exchange_symbols
+        return sorted(symbols | set(traded_symbols))
+
+    def get_binance_trades(self, account_id: str):
+        """
+        Trades newer than the stored per-symbol cursors, or the complete history when there are none.
+        The advanced cursors are kept in pending_cursors until the trades made it into Ghostfolio.
+        """
         all_trades = []
-        headers = {'X-MBX-APIKEY': self.binance_api_key}
 
+        cursor_store = self.get_cursor_store(account_id)
+        cursors = cursor_store.load() if cursor_store is not None else {}
+        symbols = self.binance_symbols
         # If no symbols were provided, derive them from account info.
-        if not self.binance_symbols:
-            account_info = self.get_binance_account_info()
+        if not symbols:
+            account_info = self.account_info or self.get_binance_account_info()
             if account_info is None:
                 logger.info("Cannot derive symbols: no account info")
                 return []
-            self.binance_symbols = self.derive_symbols_from_account(account_info)
-            logger.info("Derived trading symbols: %s", self.binance_symbols)
-
-        for symbol in self.binance_symbols:
-            params = {"symbol": symbol}
-            signed_params = self.sign_params(params)
-            try:
-                response = requests.get(base_url + endpoint, headers=headers, params=signed_params)
-            except Exception as e:
-                logger.info(e)
-                continue
-            if response.status_code == 200:
-                trades = response.json()
-                for trade in trades:
-                    trade_time = datetime.fromtimestamp(trade["time"] / 1000).isoformat()
-                    # Since we're assuming symbols match, no extra mapping is needed.
-                    mapped_symbol = symbol
-                    trade_type = "BUY" if trade.get("isBuyer", False) else "SELL"
-                    act = {
-                        "accountId": self.create_or_get_binance_accountId(),
-                        "comment": f"tradeID={trade['id']}",
-                        "currency": self.ghost_currency,
-                        "date": trade_time,
-                        "fee": abs(float(trade.get("commission", "0"))),
-                        "quantity": abs(float(trade.get("qty", "0"))),
-                        "symbol": mapped_symbol.replace("USDT", "USD"), # TODO This should use a map of symbols instead of this
-                        "type": trade_type,
-                        "unitPrice": float(trade.get("price", "0")),
-                        "binanceSymbol": symbol
-                    }
-                    all_trades.append(act)
-            else:
-                logger.info("Failed to get trades for symbol %s: %s", symbol, response.text)
+            symbols = self.derive_symbols_from_account(account_info, self.traded_symbols | cursors.keys())
+            logger.info("Derived trading symbols: %s", symbols)
+
+        with ThreadPoolExecutor(max_workers=self.binance_max_workers, thread_name_prefix="binance") as executor:
+            # Each task gets its own copy of the context so log lines keep the account prefix
+            futures = {symbol: executor.submit(contextvars.copy_context().run, self.get_symbol_trades,
+                                               symbol, account_id, cursors.get(symbol, -1) + 1)
+                       for symbol in symbols}
+            for symbol, future in futures.items():
+                trades, last_id = future.result()
+                all_trades.extend(trades)
+                if last_id is not None:
+                    self.traded_symbols.add(symbol)
+                if last_id is not None and last_id > cursors.get(symbol, -1):
+                    self.pending_cursors[symbol] = last_id
         return all_trades
 
-    def set_cash_to_account(self, account_id, cash: dict):
-        if not cash:
-            logger.info("No cash retrieved")
-            return False
-        for currency, amount in cash.items():
-            payload_data = {
-                "balance": amount,
-                "id": account_id,
-                "currency": currency,
-                "isExcluded": False,
-                "name": self.ghost_account_name,
-                "platformId": self.ghost_platform
-            }
-            url = f"{self.ghost_host}/api/v1/account/{account_id}"
-            payload = json.dumps(payload_data)
-            headers = {
-                'Authorization': f"Bearer {self.ghost_token}",
-                'Content-Type': 'application/json'
-            }
+    def get_symbol_trades(self, symbol: str, account_id: str, from_id: int = 0):
+        """Pages through myTrades starting at from_id, returns the activities and the last trade id seen."""
+        acts = []
+        last_id = None
+        while True:
+            params = {"symbol": symbol, "fromId": from_id, "limit": MY_TRADES_LIMIT}
             try:
-                response = requests.put(url, headers=headers, data=payload)
+                response = self.binance_get("/api/v3/myTrades", params, MY_TRADES_WEIGHT)
             except Exception as e:
                 logger.info(e)
-                return
-            if response.status_code == 200:
-                logger.info("Updated cash for account %s", account_id)
-            else:
-                logger.info("Failed to update cash: %s", response.text)
-
-    def create_binance_account(self):
-        payload_data = {
-            "balance": 0,
-            "currency": self.ghost_currency,
-            "isExcluded": False,
-            "name": self.ghost_account_name,
-            "platformId": self.ghost_platform
-        }
-        url = f"{self.ghost_host}/api/v1/account"
-        payload = json.dumps(payload_data)
-        headers = {
-            'Authorization': f"Bearer {self.ghost_token}",
-            'Content-Type': 'application/json'
-        }
-        try:
-            response = requests.post(url, headers=headers, data=payload)
-        except Exception as e:
-            logger.info(e)
-            return ""
-        if response.status_code == 201:
-            return response.json().get("id", "")
-        logger.info("Failed to create account: %s", response.text)
-        return ""
-
-    def get_all_accounts(self):
-        url = f"{self.ghost_host}/api/v1/account"
-        headers = {'Authorization': f"Bearer {self.ghost_token}"}
-        try:
-            response = requests.get(url, headers=headers)
-        except Exception as e:
-            logger.info(e)
-            return []
-        if response.status_code == 200:
-            return response.json().get("accounts", [])
-        return []
-
-    def create_or_get_binance_accountId(self):
-        if self.account_id is not None:
-            return self.account_id
-        accounts = self.get_all_accounts()
-        for account in accounts:
-            if account.get("name") == self.ghost_account_name:
-                self.account_id = account.get("id")
-                return self.account_id
-        self.account_id = self.create_binance_account()
-        return self.account_id
-
-    def import_act(self, bulk):
-        chunks = generate_chunks(sorted(bulk, key=lambda x: x["date"]), 10)
-        for acts in chunks:
-            url = f"{self.ghost_host}/api/v1/import"
-            payload = json.dumps({"activities": acts})
-            headers = {
-                'Authorization': f"Bearer {self.ghost_token}",
-                'Content-Type': 'application/json'
-            }
-            logger.info(payload)
-            try:
-                response = requests.post(url, headers=headers, data=payload)
-            except Exception as e:
-                logger.info(e)
-                return False
-            if response.status_code == 201:
-                logger.info("Imported activities: %s", json.dumps(response.json()))
-            else:
-                logger.info("Failed to import activities: %s", response.text)
-                return False
-        return True
-
-    def get_all_acts_for_account(self, account_id: str = None, range: str = None, symbol: str = None):
-        if account_id is None:
-            account_id = self.create_or_get_binance_accountId()
-        url = f"{self.ghost_host}/api/v1/order"
-        params = {"accounts": account_id, "range": range, "symbol": symbol}
-        headers = {'Authorization': f"Bearer {self.ghost_token}"}
-        try:
-            response = requests.get(url, headers=headers, params=params)
-        except Exception as e:
-            logger.info(e)
-            return []
-        if response.status_code == 200:
-            return response.json().get("activities", [])
-        return []
-
-    def sync_binance(self):
-        account_info = self.get_binance_account_info()
-        if account_info is None:
-            logger.info("No account info retrieved from Binance")
-            return
-        cash = self.get_cash_amount_from_binance(account_info)
-        account_id = self.create_or_get_binance_accountId()
-        if not account_id:
-            logger.info("Failed to retrieve account ID")
-            return
-        self.set_cash_to_account(account_id, cash)
-        trades = self.get_binance_trades()
-        existing_acts = self.get_all_acts_for_account()
-        diff = get_diff(existing_acts, trades)
-        if not diff:
-            logger.info("No new trades to sync")
-        else:
-            self.import_act(diff)
+                break
+            if response.status_code != 200:
+                logger.info("Failed to get trades for symbol %s: %s", symbol, response.text)
+                break
+            trades = response.json()
+            for trade in trades:
+                trade_time = datetime.fromtimestamp(trade["time"] // 1000)
+                trade_type = "BUY" if trade.get("isBuyer", False) else "SELL"
+                acts.append(Activity(
+                    account_id=account_id,
+                    comment=f"tradeID={trade['id']}",
+                    currency=self.ghost_currency,
+                    timestamp=timestamp_from_datetime(trade_time),
+                    fee=float(trade.get("commission", "0")),
+                    quantity=float(trade.get("qty", "0")),
+                    symbol=self.symbols.resolve(symbol),
+                    type=trade_type,
+                    unit_price=float(trade.get("price", "0")),
+                    broker_symbol=symbol
+                ))
+            if trades:
+                last_id = max(last_id or 0, max(trade["id"] for trade in trades))
+            if len(trades) < MY_TRADES_LIMIT:
+                break
+            from_id = last_id + 1
+        if acts:
+            logger.info("Fetched %s new trades for %s", len(acts), symbol)
+        return acts, last_id
+
+    def save_cursors(self, account_id: str):
+        cursor_store = self.get_cursor_store(account_id)
+        if cursor_store is not None:
+            cursor_store.save(self.pending_cursors)
+        self.pending_cursors = {}
+
+    def get_cursor_store(self, account_id: str) -> Optional[TradeCursorStore]:
+        if not self.state_dir:
+            return None
+        return TradeCursorStore(self.state_dir, self.sink.host, account_id)
 
 
 def main():
@@ -354,6 +349,9 @@ def main():
     # Provide a list of symbols to sync; assume symbols match on both platforms.
     # TODO ADD SYMBOLS, MAYBE TURN THIS INTO A MAPPING FILE, if too many symbols this is going to take a while
     binance_symbols = ["BTCUSDT", "ETHUSDT", "USDCUSDT", "BNBUSDT"]
+    # Directory for the synced trades ledger and per-symbol trade cursors,
+    # leave empty to always fetch and compare the full history
+    state_dir = ""
 
     sync = SyncBinance(
         ghost_host=ghost_host,
@@ -364,10 +362,13 @@ def main():
         ghost_platform=ghost_platform,
         binance_api_key=binance_api_key,
         binance_api_secret=binance_api_secret,
-        binance_symbols=binance_symbols
+        binance_symbols=binance_symbols,
+        state_dir=state_dir
     )
 
-    sync.sync_binance()
+    with metrics.collect(ghost_account_name, "SYNCBINANCE") as run_metrics:
+        sync.sync_binance()
+    metrics.log_summary_line(run_metrics)
 
 
 if __name__ == "__main__":
@@ -2,7 +2,15 @@
 
 rm -f /root/ghost.lock
 echo "Starting ghostfolio-sync Docker..."
-if [ -z "$CRON" ]; then
+# Same values main.py accepts, in any case
+case "$(echo "$DAEMON" | tr A-Z a-z)" in
+  true|1|yes) daemon=1 ;;
+  *) daemon= ;;
+esac
+if [ -n "$daemon" ]; then
+  echo "Running as a daemon, syncing every ${SYNC_INTERVAL:-3600}s"
+  exec python main.py
+elif [ -z "$CRON" ]; then
   echo "Crontab Not Present running one time now"
   python main.py
 else
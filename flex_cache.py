@@ -0,0 +1,136 @@
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from ibflex import client
+
+import metrics
+from sync_settings import SyncSettings
+
+logger = logging.getLogger(__name__)
+
+# Reports downloaded during the current run, shared by every account using the same token and query
+_run_reports = contextvars.ContextVar("flex_run_reports", default=None)
+_key_locks = {}
+_key_locks_lock = threading.Lock()
+# Held while writing and pruning, a prune must not see a blob whose ref isn't written yet
+_cache_lock = threading.Lock()
+
+
+@contextmanager
+def run_cache():
+    """Scope of one run, accounts running inside it download a report at most once."""
+    token = _run_reports.set({})
+    try:
+        yield
+    finally:
+        _run_reports.reset(token)
+
+
+def cache_key(token: str, query: str) -> str:
+    return hashlib.sha256(f"{token}:{query}".encode("utf-8")).hexdigest()
+
+
+def _key_lock(key: str) -> threading.Lock:
+    with _key_locks_lock:
+        return _key_locks.setdefault(key, threading.Lock())
+
+
+def _write_atomic(path: str, data: bytes):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def read_cached(cache_dir: str, key: str, max_age: Optional[float]) -> Optional[bytes]:
+    if not cache_dir:
+        return None
+    try:
+        with open(os.path.join(cache_dir, "refs", f"{key}.json"), "r") as file:
+            ref = json.load(file)
+        if max_age is not None and time.time() - ref["fetched_at"] > max_age:
+            return None
+        with open(os.path.join(cache_dir, "blobs", f"{ref['content']}.xml"), "rb") as file:
+            data = file.read()
+    except (OSError, ValueError, KeyError):
+        return None
+    if hashlib.sha256(data).hexdigest() != ref["content"]:
+        logger.warning("Cached Flex report %s is corrupted, ignoring it", ref["content"])
+        return None
+    logger.info("Using cached Flex report from %s", time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ref["fetched_at"])))
+    return data
+
+
+def write_cached(cache_dir: str, key: str, data: bytes):
+    """Stores the report under its content hash, the ref for key points at it."""
+    if not cache_dir:
+        return
+    os.makedirs(os.path.join(cache_dir, "blobs"), exist_ok=True)
+    os.makedirs(os.path.join(cache_dir, "refs"), exist_ok=True)
+    content = hashlib.sha256(data).hexdigest()
+    blob_path = os.path.join(cache_dir, "blobs", f"{content}.xml")
+    ref = {"content": content, "fetched_at": time.time()}
+    with _cache_lock:
+        if not os.path.exists(blob_path):
+            _write_atomic(blob_path, data)
+        _write_atomic(os.path.join(cache_dir, "refs", f"{key}.json"), json.dumps(ref).encode("utf-8"))
+        prune_blobs(cache_dir)
+
+
+def prune_blobs(cache_dir: str):
+    """Removes the blobs no ref points at, called with _cache_lock held."""
+    referenced = set()
+    for name in os.listdir(os.path.join(cache_dir, "refs")):
+        try:
+            with open(os.path.join(cache_dir, "refs", name), "r") as file:
+                referenced.add(json.load(file)["content"])
+        except (OSError, ValueError, KeyError):
+            continue
+    for name in os.listdir(os.path.join(cache_dir, "blobs")):
+        if name.endswith(".xml") and name[:-len(".xml")] not in referenced:
+            os.remove(os.path.join(cache_dir, "blobs", name))
+
+
+def download_flex(token: str, query: str, settings: SyncSettings) -> bytes:
+    """
+    Raw Flex report for token and query. Downloaded at most once per run, served from the
+    disk cache while younger than the TTL, and never downloaded in replay mode.
+    """
+    if settings.flex_file:
+        logger.info("Replaying Flex report from %s", settings.flex_file)
+        with open(settings.flex_file, "rb") as file:
+            return file.read()
+
+    key = cache_key(token, query)
+    run_reports = _run_reports.get()
+    if run_reports is None:
+        run_reports = {}
+    with _key_lock(key):
+        data = run_reports.get(key)
+        if data is not None:
+            logger.info("Reusing Flex report downloaded in this run")
+            return data
+
+        data = read_cached(settings.flex_cache_dir, key, None if settings.flex_replay else settings.flex_cache_ttl)
+        if data is None:
+            if settings.flex_replay:
+                raise Exception(f"No cached Flex report for query {query} in replay mode")
+            logger.info("Downloading Flex report")
+            data = client.download(token, query)
+            metrics.count("flex_downloads")
+            metrics.count("flex_bytes_in", len(data))
+            write_cached(settings.flex_cache_dir, key, data)
+        run_reports[key] = data
+        return data
@@ -0,0 +1,149 @@
+import io
+import logging
+import multiprocessing
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from ibflex import parser
+
+logger = logging.getLogger(__name__)
+
+# Sections of a FlexStatement whose rows are used by the sync, everything else is skipped
+ROW_SECTIONS = ("Trades", "CashReport")
+
+# Attributes the sync reads, the only ones kept of rows parsed in a worker process
+COMPACT_FIELDS = {
+    "Trades": ("tradeID", "currency", "symbol", "isin", "figi", "dateTime", "quantity", "tradePrice", "ibCommission",
+               "buySell", "openCloseIndicator"),
+    "CashReport": ("currency", "endingCash"),
+    "AccountInformation": ("currency",),
+}
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+class FlexAccountData:
+    """
+    The parts of one FlexStatement used by the sync, with the same attribute names as
+    ibflex's FlexStatement so both can be used interchangeably.
+    """
+
+    def __init__(self, account_id: str):
+        self.accountId = account_id
+        self.AccountInformation = None
+        self.Trades = []
+        self.CashReport = []
+        # Statement period, None when the report doesn't say or uses a date format ibflex can't read
+        self.fromDate = None
+        self.toDate = None
+
+
+class FlexRow:
+    """A Flex row reduced to the given attributes, a fraction of the size of ibflex's to pickle."""
+
+    def __init__(self, row, fields: tuple):
+        for field in fields:
+            setattr(self, field, getattr(row, field, None))
+
+    def __repr__(self) -> str:
+        return f"FlexRow({', '.join(f'{name}={value!r}' for name, value in vars(self).items())})"
+
+
+def statement_date(value: Optional[str]):
+    if not value:
+        return None
+    try:
+        return parser.convert_date(value)
+    except Exception as e:
+        logger.info("Could not read statement date %s: %s", value, e)
+        return None
+
+
+def parse_account_statement(source, account_id: str, compact: bool = False) -> Optional[FlexAccountData]:
+    """
+    Stream a Flex report and parse only the statement of account_id.
+    Rows are converted by ibflex one element at a time and released right after, other
+    statements and sections are dropped as soon as they are read. Compact rows only keep
+    COMPACT_FIELDS.
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+
+    data = None
+    stack = []
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            if not stack and elem.tag != "FlexQueryResponse":
+                raise parser.FlexParserError("Not a FlexQueryResponse")
+            if elem.tag == "FlexStatement" and elem.get("accountId") == account_id:
+                data = FlexAccountData(account_id)
+                data.fromDate = statement_date(elem.get("fromDate"))
+                data.toDate = statement_date(elem.get("toDate"))
+            stack.append(elem)
+            continue
+
+        stack.pop()
+        parent = stack[-1].tag if stack else None
+        in_target = data is not None
+        if elem.tag == "FlexStatement":
+            elem.clear()
+            if in_target:
+                # Statements after the target one are never read
+                break
+        elif in_target and parent in ROW_SECTIONS:
+            row = parser.parse_data_element(elem)
+            if row is not None:
+                getattr(data, parent).append(FlexRow(row, COMPACT_FIELDS[parent]) if compact else row)
+            elem.clear()
+        elif in_target and elem.tag == "AccountInformation":
+            data.AccountInformation = parser.parse_data_element(elem)
+            if compact:
+                data.AccountInformation = FlexRow(data.AccountInformation, COMPACT_FIELDS["AccountInformation"])
+            elem.clear()
+        elif parent == "FlexStatement":
+            elem.clear()
+
+    if data is None:
+        logger.error("No Flex statement found for account %s", account_id)
+    else:
+        logger.info("Parsed Flex statement for %s: %s trades, %s cash report rows",
+                    account_id, len(data.Trades), len(data.CashReport))
+    return data
+
+
+def parse_flex(source: bytes, account_id: str, processes: int = 0) -> Optional[FlexAccountData]:
+    """
+    parse_account_statement, in one of `processes` worker processes when above 0 so reports of
+    several accounts are parsed on several cores. Only the compact statement comes back.
+    """
+    if processes <= 0:
+        return parse_account_statement(source, account_id)
+    data = get_pool(processes).submit(parse_account_statement, source, account_id, True).result()
+    if data is not None:
+        logger.info("Parsed Flex statement for %s in a worker process: %s trades, %s cash report rows",
+                    account_id, len(data.Trades), len(data.CashReport))
+    else:
+        logger.error("No Flex statement found for account %s", account_id)
+    return data
+
+
+def get_pool(processes: int) -> ProcessPoolExecutor:
+    """The worker processes of the run, started on first use and shared by every account."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawned rather than forked, the coordinator has threads that may hold locks
+            _pool = ProcessPoolExecutor(max_workers=processes,
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def close_parse_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
@@ -0,0 +1,244 @@
+import base64
+import json
+import logging
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Iterable, Iterator, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+from state import TokenStore
+from sync_settings import SyncSettings
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Tokens fetched from a key are renewed once they expire within this many seconds
+TOKEN_REFRESH_MARGIN = 300
+
+# Activities requested per page of /api/v1/order
+ORDER_PAGE_SIZE = 1000
+
+# Days subtracted from the earliest trade before picking a range, covers timezone shifts of stored dates
+RANGE_MARGIN_DAYS = 2
+
+# (host, retries, backoff, pool size) -> session
+_sessions = {}
+_sessions_lock = threading.Lock()
+# (host, key) -> (token, expires_at), shared by every client using the same key
+_tokens = {}
+_token_locks = {}
+_token_locks_lock = threading.Lock()
+
+
+class GhostfolioRetry(Retry):
+    """
+    Retries idempotent calls on 429 and 5xx. A POST is only retried on 429, where
+    Ghostfolio rejected it before doing anything, so an import is never sent twice.
+    """
+
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        if method and method.upper() == "POST":
+            return bool(self.total) and status_code == 429
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def get_session(host: str, settings: SyncSettings) -> requests.Session:
+    """Keep-alive session shared by every client talking to the same host with the same settings."""
+    scope = (host.rstrip("/"), settings.ghost_retries, settings.ghost_backoff, settings.ghost_pool_size)
+    with _sessions_lock:
+        session = _sessions.get(scope)
+        if session is None:
+            retry = GhostfolioRetry(total=settings.ghost_retries,
+                                    backoff_factor=settings.ghost_backoff,
+                                    status_forcelist=RETRY_STATUSES,
+                                    raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.ghost_pool_size, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[scope] = session
+        return session
+
+
+def token_expiry(token: str) -> Optional[float]:
+    """The exp claim of a JWT, None when the token doesn't carry one or isn't a JWT."""
+    try:
+        claims = token.split(".")[1]
+        claims += "=" * (-len(claims) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(claims))["exp"])
+    except (IndexError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _token_valid(expires_at: Optional[float]) -> bool:
+    return expires_at is None or expires_at - TOKEN_REFRESH_MARGIN > time.time()
+
+
+def _token_lock(host: str, key: str) -> threading.Lock:
+    with _token_locks_lock:
+        return _token_locks.setdefault((host, key), threading.Lock())
+
+
+def get_token(host: str, key: str, settings: SyncSettings, rejected: str = None) -> str:
+    """
+    Bearer token for key, fetched once per host and key and reused from memory or, with
+    settings.token_dir, the state directory until it is about to expire. `rejected` is a
+    token Ghostfolio refused, it is never handed out again.
+    """
+    host = host.rstrip("/")
+    with _token_lock(host, key):
+        token, expires_at = _tokens.get((host, key), ("", None))
+        if token and token != rejected and _token_valid(expires_at):
+            return token
+
+        store = TokenStore(settings.token_dir) if settings.token_dir else None
+        if store is not None:
+            stored = store.load(host, key)
+            if stored is not None and stored[0] != rejected and _token_valid(stored[1]):
+                _tokens[(host, key)] = stored
+                return stored[0]
+
+        token = GhostfolioClient(host, settings=settings).create_token(key)
+        if not token:
+            _tokens.pop((host, key), None)
+            if store is not None:
+                store.delete(host, key)
+            return ""
+        expires_at = token_expiry(token)
+        _tokens[(host, key)] = (token, expires_at)
+        if store is not None:
+            store.save(host, key, token, expires_at)
+        return token
+
+
+def range_start_dates(today: date) -> list:
+    """Start dates of Ghostfolio's date ranges, from the narrowest to the widest."""
+    def years_ago(years: int) -> date:
+        try:
+            return today.replace(year=today.year - years)
+        except ValueError:  # 29th of February
+            return today.replace(year=today.year - years, day=28)
+
+    return [("wtd", today - timedelta(days=today.weekday())),
+            ("mtd", today.replace(day=1)),
+            ("ytd", today.replace(month=1, day=1)),
+            ("1y", years_ago(1)),
+            ("5y", years_ago(5))]
+
+
+def date_range_for_acts(acts: Iterable, today: date = None) -> Optional[str]:
+    """
+    Narrowest Ghostfolio date range holding every activity in acts, None means the whole
+    history has to be fetched, also when there are no activities.
+    """
+    try:
+        return date_range_from(min(act.timestamp for act in acts), today)
+    except ValueError:
+        return None
+
+
+def date_range_from(timestamp: int, today: date = None) -> Optional[str]:
+    """Narrowest Ghostfolio date range starting before timestamp, None being the whole history."""
+    earliest = datetime.fromtimestamp(timestamp, timezone.utc).date()
+    start = earliest - timedelta(days=RANGE_MARGIN_DAYS)
+    for date_range, range_start in range_start_dates(today or date.today()):
+        if range_start <= start:
+            return date_range
+    return None
+
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+class GhostfolioClient:
+    """
+    Requests against one Ghostfolio host. With a key the bearer token comes from get_token,
+    it is renewed before it expires and once more when Ghostfolio answers 401.
+    """
+
+    def __init__(self, host: str, token: str = "", key: str = "", settings: SyncSettings = None):
+        self.host = host.rstrip("/")
+        self.token = token
+        self.key = key
+        self.settings = settings or SyncSettings()
+        self.timeout = self.settings.ghost_timeout
+        self.session = get_session(self.host, self.settings)
+
+    def request(self, method: str, path: str, payload=None, params: dict = None) -> requests.Response:
+        if self.key:
+            self.token = get_token(self.host, self.key, self.settings)
+        data = None
+        if payload is not None:
+            data = json.dumps(payload)
+        response = self._send(method, path, data, params)
+        if response.status_code == 401 and self.key:
+            logger.info("Bearer token rejected, fetching a new one")
+            self.token = get_token(self.host, self.key, self.settings, rejected=self.token)
+            response = self._send(method, path, data, params)
+        return response
+
+    def _send(self, method: str, path: str, data: Optional[str], params: Optional[dict]) -> requests.Response:
+        headers = {}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        if data is not None:
+            headers["Content-Type"] = "application/json"
+        response = self.session.request(method, f"{self.host}{path}", headers=headers, params=params, data=data,
+                                        timeout=self.timeout)
+        metrics.count_response("ghostfolio", response, len(data) if data else 0)
+        return response
+
+    def get(self, path: str, params: dict = None) -> requests.Response:
+        return self.request("GET", path, params=params)
+
+    def post(self, path: str, payload=None) -> requests.Response:
+        return self.request("POST", path, payload=payload)
+
+    def put(self, path: str, payload=None) -> requests.Response:
+        return self.request("PUT", path, payload=payload)
+
+    def delete(self, path: str, params: dict = None) -> requests.Response:
+        return self.request("DELETE", path, params=params)
+
+    def activity_pages(self, params: dict) -> Iterator[list]:
+        """Pages of the activities matching params, read with skip and take one request at a time."""
+        skip = 0
+        previous_ids = None
+        while True:
+            response = self.get("/api/v1/order", params=dict(params, skip=skip, take=ORDER_PAGE_SIZE))
+            if response.status_code != 200:
+                raise Exception(f"Failed fetching activities: {response.status_code}")
+            body = response.json()
+            page = body.get("activities", [])
+            page_ids = [act.get("id") for act in page]
+            if page and page_ids == previous_ids:
+                # skip was ignored, the previous page was everything there is
+                return
+            yield page
+            skip += len(page)
+            previous_ids = page_ids
+            # Servers without paging answer everything at once and don't tell the count
+            if len(page) != ORDER_PAGE_SIZE or "count" not in body or skip >= body["count"]:
+                return
+
+    def create_token(self, ghost_key: str) -> str:
+        try:
+            response = self.post("/api/v1/auth/anonymous", {"accessToken": ghost_key})
+        except Exception as e:
+            logger.info(e)
+            return ""
+        if response.status_code == 201:
+            logger.info("Bearer token fetched")
+            return response.json().get("authToken", "")
+        logger.info("Failed fetching bearer token")
+        return ""
@@ -0,0 +1,150 @@
+import contextvars
+import logging
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Statuses of Ghostfolio refusing the activities themselves, any other failure stops the import
+REJECTED_STATUSES = (400, 422)
+
+class ImportResult:
+    def __init__(self):
+        self.imported: List[dict] = []
+        self.failed: List[dict] = []
+        # Failed activities Ghostfolio rejected on their own, the rest failed along with others
+        self.rejected: List[dict] = []
+        self.requests = 0
+        self.seconds = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return len(self.failed) == 0
+
+    @property
+    def throughput(self) -> float:
+        return len(self.imported) / self.seconds if self.seconds > 0 else 0.0
+
+
+class Chunk:
+    def __init__(self, acts: list, is_split: bool = False):
+        self.acts = acts
+        self.is_split = is_split
+        self.symbols = {act.symbol for act in acts}
+
+
+class ImportPipeline:
+    """
+    Posts activities to Ghostfolio in chunks.
+
+    The chunk size grows while requests come back faster than target_latency and shrinks
+    on slow or failed requests. Up to max_in_flight chunks are sent at once, as long as
+    they don't share a symbol, so the activities of one symbol are still imported in
+    date order. A chunk Ghostfolio rejects as invalid is split in halves until the
+    offending activities are isolated, the rest of the import carries on. A 5xx or a
+    request that never got an answer may have been committed, it stops the import
+    instead so nothing is posted twice, the next sync picks up what is missing.
+    """
+
+    def __init__(self, post_chunk: Callable[[list], int], chunk_size: int = 10, min_chunk_size: int = 1,
+                 max_chunk_size: int = 100, max_in_flight: int = 1, target_latency: float = 5.0):
+        self.post_chunk = post_chunk
+        self.min_chunk_size = max(1, min_chunk_size)
+        self.max_chunk_size = max(self.min_chunk_size, max_chunk_size)
+        self.chunk_size = min(max(chunk_size, self.min_chunk_size), self.max_chunk_size)
+        self.max_in_flight = max(1, max_in_flight)
+        self.target_latency = target_latency
+
+    def run(self, acts: list) -> ImportResult:
+        """Imports acts, which are expected to be sorted by date."""
+        result = ImportResult()
+        pending = deque(acts)
+        retries = deque()
+        in_flight = {}
+        stopped = False
+        start = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="import") as executor:
+            while pending or retries or in_flight:
+                while not stopped and len(in_flight) < self.max_in_flight:
+                    chunk = self.next_chunk(pending, retries)
+                    if chunk is None:
+                        break
+                    busy_symbols = set().union(*(running.symbols for running in in_flight.values()))
+                    if chunk.symbols & busy_symbols:
+                        # Waits first in line, the halves of a chunk failing meanwhile go before it
+                        retries.appendleft(chunk)
+                        break
+                    future = executor.submit(contextvars.copy_context().run, self.send, chunk)
+                    in_flight[future] = chunk
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk = in_flight.pop(future)
+                    status, latency = future.result()
+                    result.requests += 1
+                    if not self.handle(chunk, status, latency, retries, result):
+                        stopped = True
+                    if stopped:
+                        # Chunks still in flight finish, but nothing is posted after the stop, not even their halves
+                        for retry in retries:
+                            result.failed.extend(retry.acts)
+                        result.failed.extend(pending)
+                        retries.clear()
+                        pending.clear()
+
+        result.seconds = time.monotonic() - start
+        logger.info("Imported %s activities in %.1fs (%.1f activities/s) using %s requests, %s failed",
+                    len(result.imported), result.seconds, result.throughput, result.requests, len(result.failed))
+        return result
+
+    def next_chunk(self, pending: deque, retries: deque) -> Optional[Chunk]:
+        if retries:
+            return retries.popleft()
+        if not pending:
+            return None
+        return Chunk([pending.popleft() for _ in range(min(self.chunk_size, len(pending)))])
+
+    def send(self, chunk: Chunk):
+        start = time.monotonic()
+        try:
+            status = self.post_chunk(chunk.acts)
+        except Exception as e:
+            logger.info(e)
+            status = None
+        return status, time.monotonic() - start
+
+    def handle(self, chunk: Chunk, status: Optional[int], latency: float, retries: deque,
+               result: ImportResult) -> bool:
+        """False when the import has to stop."""
+        if status is not None and 200 <= status < 300:
+            result.imported.extend(chunk.acts)
+            if not chunk.is_split:
+                self.adapt(latency)
+            return True
+
+        if status not in REJECTED_STATUSES:
+            logger.warning("Import of %s activities failed with %s, stopping the import",
+                           len(chunk.acts), status or "no answer")
+            result.failed.extend(chunk.acts)
+            return False
+        if not chunk.is_split:
+            self.chunk_size = max(self.min_chunk_size, self.chunk_size // 2)
+        if len(chunk.acts) == 1:
+            logger.info("Giving up on activity: %s", chunk.acts[0])
+            result.failed.extend(chunk.acts)
+            result.rejected.extend(chunk.acts)
+            return True
+        middle = len(chunk.acts) // 2
+        logger.info("Import of %s activities was rejected, retrying in two halves", len(chunk.acts))
+        retries.appendleft(Chunk(chunk.acts[middle:], is_split=True))
+        retries.appendleft(Chunk(chunk.acts[:middle], is_split=True))
+        return True
+
+    def adapt(self, latency: float):
+        if latency > self.target_latency:
+            self.chunk_size = max(self.min_chunk_size, self.chunk_size * 3 // 4)
+        elif latency < self.target_latency / 2:
+            self.chunk_size = min(self.max_chunk_size, self.chunk_size + max(1, self.chunk_size // 4))
@@ -0,0 +1,27 @@
+import contextvars
+import logging
+from contextlib import contextmanager
+
+current_account = contextvars.ContextVar("current_account", default="-")
+
+
+class AccountLogFilter(logging.Filter):
+    """Adds the account being processed by the current thread as %(account)s."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.account = current_account.get()
+        return True
+
+
+def install_account_filter():
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(AccountLogFilter())
+
+
+@contextmanager
+def account_context(label: str):
+    token = current_account.set(label)
+    try:
+        yield
+    finally:
+        current_account.reset(token)
@@ -1,11 +1,27 @@
+import asyncio
 import logging
 import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import metrics
 from SyncIBKR import SyncIBKR
+from activity_io import export_activities
+from ghostfolio_client import GhostfolioClient
+from flex_cache import run_cache
+from flex_stream import close_parse_pool
+from log_context import account_context, install_account_filter
+from prefetch import GhostfolioPrefetch
+from plan import SyncPlan, plan_path
 from pretty_print import pretty_print_table
+from scheduler import Scheduler
+from sync_settings import SyncSettings
 
-template = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+template = "%(asctime)s - %(name)s - %(levelname)s - [%(account)s] %(message)s"
 logging.basicConfig(level=logging.INFO, format=template)
+install_account_filter()
 logger = logging.getLogger(__name__)
 
 SYNCIBKR = "SYNCIBKR"
@@ -14,6 +30,16 @@ DELETE_ALL_ACTS = "DELETE_ALL_ACTS"
 
 GET_ALL_ACTS = "GET_ALL_ACTS"
 
+PLAN = "PLAN"
+
+APPLY = "APPLY"
+
+RECONCILE = "RECONCILE"
+
+EXPORT = "EXPORT"
+
+IMPORT = "IMPORT"
+
 ghost_keys = os.environ.get("GHOST_KEY", "").split(",")
 ghost_tokens = os.environ.get("GHOST_TOKEN", "").split(",")
 ibkr_tokens = os.environ.get("IBKR_TOKEN", "").split(",")
@@ -24,43 +50,283 @@ ghost_account_names = os.environ.get("GHOST_ACCOUNT_NAME", "Interactive Brokers"
 ghost_currencies = os.environ.get("GHOST_CURRENCY", "USD").split(",")
 operations = os.environ.get("OPERATION", SYNCIBKR).split(",")
 ghost_ibkr_platforms = os.environ.get("GHOST_IBKR_PLATFORM", "").split(",")
+state_dir = os.environ.get("STATE_DIR", "")
+ghost_timeout = float(os.environ.get("GHOST_TIMEOUT", "30"))
+ghost_retries = int(os.environ.get("GHOST_RETRIES", "3"))
+ghost_backoff = float(os.environ.get("GHOST_BACKOFF", "1"))
+ghost_token_cache = os.environ.get("GHOST_TOKEN_CACHE", "false").lower() in ("1", "true", "yes")
+max_parallel_accounts = max(1, int(os.environ.get("MAX_PARALLEL_ACCOUNTS", "1")))
+import_chunk_size = int(os.environ.get("IMPORT_CHUNK_SIZE", "10"))
+import_max_chunk_size = int(os.environ.get("IMPORT_MAX_CHUNK_SIZE", "100"))
+import_in_flight = max(1, int(os.environ.get("IMPORT_IN_FLIGHT", "1")))
+reconcile_max_deletes = max(1, int(os.environ.get("RECONCILE_MAX_DELETES", "4")))
+import_target_latency = float(os.environ.get("IMPORT_TARGET_LATENCY", "5"))
+flex_cache_dir = os.environ.get("FLEX_CACHE_DIR", os.path.join(state_dir, "flex") if state_dir else "")
+flex_cache_ttl = float(os.environ.get("FLEX_CACHE_TTL", "0"))
+flex_replay = os.environ.get("FLEX_REPLAY", "false").lower() in ("1", "true", "yes")
+flex_file = os.environ.get("FLEX_FILE", "")
+flex_processes = max(0, int(os.environ.get("FLEX_PROCESSES", "0")))
+plan_dir = os.environ.get("PLAN_DIR", os.path.join(state_dir, "plans") if state_dir else "plans")
+symbol_retry_days = float(os.environ.get("SYMBOL_RETRY_DAYS", "7"))
+cash_tolerance = float(os.environ.get("CASH_TOLERANCE", "0.01"))
+cash_per_currency = os.environ.get("CASH_PER_CURRENCY", "false").lower() in ("1", "true", "yes")
+log_payloads = os.environ.get("LOG_PAYLOADS", "summary").lower()
+metrics_textfile = os.environ.get("METRICS_TEXTFILE", "")
+metrics_pushgateway = os.environ.get("METRICS_PUSHGATEWAY", "")
+daemon = os.environ.get("DAEMON", "false").lower() in ("1", "true", "yes")
+export_files = os.environ.get("EXPORT_FILE", "").split(",")
+export_format = os.environ.get("EXPORT_FORMAT", "") or None
+export_columns = [column.strip() for column in os.environ.get("EXPORT_COLUMNS", "").split(",") if column.strip()]
+import_batch_size = max(1, int(os.environ.get("IMPORT_BATCH_SIZE", "1000")))
+sync_intervals = os.environ.get("SYNC_INTERVAL", "3600").split(",")
+sync_jitter = float(os.environ.get("SYNC_JITTER", "60"))
+
+settings = SyncSettings(
+    ghost_timeout=ghost_timeout, ghost_retries=ghost_retries, ghost_backoff=ghost_backoff,
+    ghost_pool_size=max(10, max_parallel_accounts * max(import_in_flight, reconcile_max_deletes)),
+    token_dir=state_dir if ghost_token_cache else "",
+    import_chunk_size=import_chunk_size, import_max_chunk_size=import_max_chunk_size,
+    import_in_flight=import_in_flight, import_target_latency=import_target_latency,
+    flex_cache_dir=flex_cache_dir, flex_cache_ttl=flex_cache_ttl, flex_replay=flex_replay, flex_file=flex_file,
+    flex_processes=flex_processes, log_payloads=log_payloads, symbol_retry_after=symbol_retry_days * 24 * 3600,
+    cash_tolerance=cash_tolerance, max_deletes_in_flight=reconcile_max_deletes)
+
+# Sync instances live as long as the process, so in daemon mode their token, mapping and
+# account id are reused by every run
+syncs = {}
+# Last summary of every operation, exported as metrics after each daemon run
+latest_results = {}
+latest_results_lock = threading.Lock()
+# Accounts and activities fetched once per Ghostfolio host and credentials for a one-time run
+prefetches = {}
+
+
+def pick(values: list, i: int) -> str:
+    return values[i] if len(values) > i else values[-1]
+
+
+def get_operation_config(i: int) -> dict:
+    return {
+        "operation": operations[i],
+        "ghost_host": pick(ghost_hosts, i),
+        "ibkr_token": pick(ibkr_tokens, i),
+        "ibkr_query": pick(ibkr_queries, i),
+        "ghost_key": pick(ghost_keys, i),
+        "ghost_token": pick(ghost_tokens, i),
+        "ibkr_account_id": pick(ibkr_account_ids, i),
+        "ghost_account_name": pick(ghost_account_names, i),
+        "ghost_currency": pick(ghost_currencies, i),
+        "ghost_ibkr_platform": pick(ghost_ibkr_platforms, i),
+        "export_file": pick(export_files, i),
+    }
+
+
+def group_by_ghost_account(indexes) -> list:
+    """Operations on the same Ghostfolio account, in their configured order, never overlap."""
+    groups = {}
+    for i in indexes:
+        config = get_operation_config(i)
+        groups.setdefault((config["ghost_host"].rstrip("/"), config["ghost_account_name"]), []).append(i)
+    return list(groups.values())
+
+
+def ghost_user(config: dict) -> tuple:
+    """Operations with the same host and credentials see the same Ghostfolio accounts."""
+    token = config["ghost_token"]
+    return config["ghost_host"].rstrip("/"), token, "" if token else config["ghost_key"]
+
+
+def build_prefetches(indexes) -> dict:
+    account_names = {}
+    # Users with an operation listing every activity, their prefetch asks for the whole history right away
+    whole_history = set()
+    for i in indexes:
+        config = get_operation_config(i)
+        if config["operation"] in (SYNCIBKR, GET_ALL_ACTS, PLAN, RECONCILE):
+            account_names.setdefault(ghost_user(config), set()).add(config["ghost_account_name"])
+        if config["operation"] == GET_ALL_ACTS:
+            whole_history.add(ghost_user(config))
+    result = {}
+    for (host, token, key), names in account_names.items():
+        result[(host, token, key)] = GhostfolioPrefetch(GhostfolioClient(host, token=token, key=key, settings=settings),
+                                                      names, (host, token, key) in whole_history)
+    return result
+
+
+def get_sync(i: int, config: dict) -> SyncIBKR:
+    ghost = syncs.get(i)
+    if ghost is None:
+        ghost = SyncIBKR(config["ghost_host"], config["ibkr_token"], config["ibkr_query"], config["ghost_key"],
+                         config["ghost_token"], config["ibkr_account_id"], config["ghost_account_name"],
+                         config["ghost_currency"], config["ghost_ibkr_platform"], state_dir=state_dir,
+                         cash_per_currency=cash_per_currency, settings=settings)
+        syncs[i] = ghost
+    return ghost
+
+
+async def run_operation(i: int, config: dict):
+    ghost = await asyncio.to_thread(get_sync, i, config)
+    ghost.sink.prefetch = prefetches.get(ghost_user(config))
+    operation = config["operation"]
+    if operation == SYNCIBKR:
+        logger.info("Starting sync for account %s: %s", i, ibkr_account_ids[i] if len(ibkr_account_ids) > i else "Unknown")
+        if not await ghost.engine.sync():
+            raise Exception("Sync did not complete, see the log")
+        logger.info("End sync")
+    elif operation == GET_ALL_ACTS:
+        logger.info("Getting all activities")
+        logger.info("Start of operation")
+        table_data = []
+        activities = await asyncio.to_thread(ghost.sink.get_activities)
+        for activity in activities:
+            table_data.append([activity['id'], activity['SymbolProfile']['name'], activity['type'],
+                               activity['date'], activity['quantity'], activity['fee'], activity['value'],
+                               activity['SymbolProfile']['currency'], activity['comment']])
+        table = pretty_print_table(["ID", "NAME", "TYPE", "DATE", "QUANTITY",
+                                    "FEE", "VALUE", "CURRENCY", "COMMENT"],
+                                   table_data)
+        logger.info("\n%s", table)
+        logger.info("End of operation")
+    elif operation == PLAN:
+        logger.info("Planning sync for account %s", config["ibkr_account_id"])
+        plan = await ghost.engine.plan(dry_run=True)
+        if plan is None:
+            raise Exception("Could not plan the sync, see the log")
+        path = plan_path(plan_dir, config["ghost_host"], config["ghost_account_name"], config["ibkr_account_id"])
+        await asyncio.to_thread(plan.save, path)
+        logger.info("End plan")
+    elif operation == APPLY:
+        path = plan_path(plan_dir, config["ghost_host"], config["ghost_account_name"], config["ibkr_account_id"])
+        if not os.path.exists(path):
+            logger.info("No plan to apply at %s", path)
+            return
+        plan = await asyncio.to_thread(SyncPlan.load, path)
+        logger.info("Applying plan from %s with %s activities", time.strftime("%Y-%m-%d %H:%M:%S",
+                    time.localtime(plan.created_at)), len(plan.activities))
+        if not await ghost.engine.apply(plan, verify=True):
+            raise Exception(f"Plan {path} was not fully applied")
+        SyncPlan.mark_applied(path)
+        logger.info("End apply")
+    elif operation == RECONCILE:
+        logger.info("Reconciling account %s", config["ibkr_account_id"])
+        if not await asyncio.to_thread(ghost.reconcile_ibkr):
+            raise Exception("Reconcile left activities behind, see the log")
+        logger.info("End reconcile")
+    elif operation == EXPORT:
+        path = config["export_file"]
+        if not path:
+            raise Exception("EXPORT_FILE is required to export activities")
+        account_id = await asyncio.to_thread(ghost.sink.find_account_id)
+        if account_id == "":
+            raise Exception(f"No Ghostfolio account {config['ghost_account_name']} to export")
+        logger.info("Exporting activities into %s", path)
+        count = await asyncio.to_thread(export_activities, ghost.sink.iter_activities(account_id), path,
+                                        export_format, export_columns)
+        metrics.count("activities_exported", count)
+        logger.info("End export")
+    elif operation == IMPORT:
+        path = config["export_file"]
+        if not os.path.exists(path):
+            raise Exception(f"No activity file to import at {path}")
+        logger.info("Importing activities from %s", path)
+        if not await asyncio.to_thread(ghost.engine.import_file, path, export_format, import_batch_size):
+            raise Exception(f"Activities of {path} were not all imported")
+        logger.info("End import")
+    elif operation == DELETE_ALL_ACTS:
+        logger.info("Starting delete")
+        await asyncio.to_thread(ghost.sink.delete_all_acts)
+        logger.info("End delete")
+    else:
+        logger.info("Unknown Operation")
+
+
+async def run_account(i: int) -> dict:
+    config = get_operation_config(i)
+    label = f"{i}:{config['ibkr_account_id'] or config['ghost_account_name']}"
+    summary = {"index": i, "operation": config["operation"], "account": label, "status": "OK", "detail": ""}
+    with account_context(label):
+        start = time.monotonic()
+        with metrics.collect(label, config["operation"]) as run_metrics:
+            try:
+                await run_operation(i, config)
+            except Exception as e:
+                logger.exception("Operation %s failed", config["operation"])
+                # Start from a fresh token and account lookup next time
+                syncs.pop(i, None)
+                summary["status"] = "FAILED"
+                summary["detail"] = str(e)
+            run_metrics.status = summary["status"]
+        summary["seconds"] = round(time.monotonic() - start, 1)
+        summary["metrics"] = run_metrics
+        metrics.log_summary_line(run_metrics)
+    return summary
+
+
+async def run_group(indexes: list) -> list:
+    return [await run_account(i) for i in indexes]
+
+
+async def run_groups(groups: list) -> list:
+    """Every group is a task on the same event loop, up to max_parallel_accounts of them run at once."""
+    limit = asyncio.Semaphore(max_parallel_accounts)
+    # Blocking calls run through asyncio.to_thread, whose default pool is sized from the CPUs. An account
+    # can block on its Flex download and its account lookup at once, so every account gets two threads
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=max_parallel_accounts * 2, thread_name_prefix="account"))
+
+    async def run_limited(indexes: list) -> list:
+        async with limit:
+            return await run_group(indexes)
+
+    results = await asyncio.gather(*(run_limited(indexes) for indexes in groups))
+    return sorted((summary for group in results for summary in group), key=lambda s: s["index"])
+
+
+def run_scheduled_group(indexes: list):
+    with run_cache():
+        summaries = asyncio.run(run_group(indexes))
+    with latest_results_lock:
+        for summary in summaries:
+            latest_results[summary["index"]] = summary
+        export_metrics(sorted(latest_results.values(), key=lambda s: s["index"]))
+
+
+def log_summary(summaries: list):
+    table = pretty_print_table(["#", "OPERATION", "ACCOUNT", "STATUS", "SECONDS", "DETAIL"],
+                               [[s["index"], s["operation"], s["account"], s["status"], s["seconds"], s["detail"]]
+                                for s in summaries])
+    logger.info("Summary:\n%s", table)
+
+
+def export_metrics(summaries: list):
+    if metrics_textfile:
+        metrics.write_textfile(metrics_textfile, [summary["metrics"] for summary in summaries])
+    if metrics_pushgateway:
+        metrics.push_to_gateway(metrics_pushgateway, [summary["metrics"] for summary in summaries])
+
+
+def run_daemon():
+    """Keeps running, every Ghostfolio account is synced on the interval of its first operation."""
+    scheduler = Scheduler(run_scheduled_group, max_workers=max_parallel_accounts, jitter=sync_jitter)
+    for indexes in group_by_ghost_account(range(len(operations))):
+        interval = float(pick(sync_intervals, indexes[0]))
+        scheduler.add(f"Operations {', '.join(str(i) for i in indexes)}", indexes, interval)
+        logger.info("Scheduling operations %s every %ss", indexes, interval)
+    signal.signal(signal.SIGTERM, lambda *_: scheduler.stop())
+    signal.signal(signal.SIGINT, lambda *_: scheduler.stop())
+    scheduler.run_forever()
 
 
 if __name__ == '__main__':
-    for i in range(len(operations)):
-        ghost_host = ghost_hosts[i] if len(ghost_hosts) > i else ghost_hosts[-1]
-        ibkr_token = ibkr_tokens[i] if len(ibkr_tokens) > i else ibkr_tokens[-1]
-        ibkr_query = ibkr_queries[i] if len(ibkr_queries) > i else ibkr_queries[-1]
-        ghost_key = ghost_keys[i] if len(ghost_keys) > i else ghost_keys[-1]
-        ghost_token = ghost_tokens[i] if len(ghost_tokens) > i else ghost_tokens[-1]
-        ibkr_account_id = ibkr_account_ids[i] if len(ibkr_account_ids) > i else ibkr_account_ids[-1]
-        ghost_account_name = ghost_account_names[i] if len(ghost_account_names) > i else ghost_account_names[-1]
-        ghost_currency = ghost_currencies[i] if len(ghost_currencies) > i else ghost_currencies[-1]
-        ghost_ibkr_platform = ghost_ibkr_platforms[i] if len(ghost_ibkr_platforms) > i else ghost_ibkr_platforms[-1]
-
-        ghost = SyncIBKR(ghost_host, ibkr_token, ibkr_query, ghost_key, ghost_token, ibkr_account_id,
-                         ghost_account_name, ghost_currency, ghost_ibkr_platform)
-        if operations[i] == SYNCIBKR:
-            logger.info("Starting sync for account %s: %s", i, ibkr_account_ids[i] if len(ibkr_account_ids) > i else "Unknown")
-            ghost.sync_ibkr()
-            logger.info("End sync")
-        elif operations[i] == GET_ALL_ACTS:
-            logger.info("Getting all activities")
-            logger.info("Start of operation")
-            table_data = []
-            activities = ghost.get_all_acts_for_account()
-            for activity in activities:
-                table_data.append([activity['id'], activity['SymbolProfile']['name'], activity['type'],
-                                   activity['date'], activity['quantity'], activity['fee'], activity['value'],
-                                   activity['SymbolProfile']['currency'], activity['comment']])
-            table = pretty_print_table(["ID", "NAME", "TYPE", "DATE", "QUANTITY",
-                                        "FEE", "VALUE", "CURRENCY", "COMMENT"],
-                                       table_data)
-            logger.info("\n%s", table)
-            logger.info("End of operation")
-        elif operations[i] == DELETE_ALL_ACTS:
-            logger.info("Starting delete")
-            ghost.delete_all_acts()
-            logger.info("End delete")
-        else:
-            logger.info("Unknown Operation")
+    if daemon:
+        run_daemon()
+        close_parse_pool()
+        raise SystemExit(0)
+    prefetches.update(build_prefetches(range(len(operations))))
+    with run_cache():
+        results = asyncio.run(run_groups(group_by_ghost_account(range(len(operations)))))
+    close_parse_pool()
+    log_summary(results)
+    export_metrics(results)
+    if any(result["status"] != "OK" for result in results):
+        raise SystemExit(1)
@@ -0,0 +1,135 @@
+import contextvars
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Iterable, Optional
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = "ghostfolio_sync"
+
+current_metrics = contextvars.ContextVar("current_metrics", default=None)
+
+
+class SyncMetrics:
+    """Phase timings and counters of one operation, shared by every thread working on it."""
+
+    def __init__(self, account: str, operation: str):
+        self.account = account
+        self.operation = operation
+        self.status = "OK"
+        self.finished_at = 0.0
+        self.phases = {}
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def add_phase(self, name: str, seconds: float):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "account": self.account,
+                "operation": self.operation,
+                "status": self.status,
+                "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+                "counters": dict(self.counters),
+            }
+
+
+@contextmanager
+def collect(account: str, operation: str):
+    metrics = SyncMetrics(account, operation)
+    token = current_metrics.set(metrics)
+    start = time.monotonic()
+    try:
+        yield metrics
+    finally:
+        metrics.add_phase("total", time.monotonic() - start)
+        metrics.finished_at = time.time()
+        current_metrics.reset(token)
+
+
+@contextmanager
+def phase(name: str):
+    """Times a block into the metrics of the running operation, a no-op outside of one."""
+    metrics: Optional[SyncMetrics] = current_metrics.get()
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        if metrics is not None:
+            metrics.add_phase(name, time.monotonic() - start)
+
+
+def count(name: str, value: int = 1):
+    metrics: Optional[SyncMetrics] = current_metrics.get()
+    if metrics is not None:
+        metrics.count(name, value)
+
+
+def count_response(target: str, response: requests.Response, bytes_sent: int = 0):
+    count(f"{target}_requests")
+    count(f"{target}_bytes_in", len(response.content))
+    if bytes_sent:
+        count(f"{target}_bytes_out", bytes_sent)
+
+
+def log_summary_line(metrics: SyncMetrics):
+    logger.info("Metrics: %s", json.dumps(metrics.to_dict(), sort_keys=True))
+
+
+def _label_value(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def to_prometheus(all_metrics: Iterable[SyncMetrics]) -> str:
+    samples = {}
+    for metrics in all_metrics:
+        labels = f'account="{_label_value(metrics.account)}",operation="{_label_value(metrics.operation)}"'
+        samples.setdefault("success", []).append((labels, 1 if metrics.status == "OK" else 0))
+        samples.setdefault("last_run_timestamp_seconds", []).append((labels, metrics.finished_at))
+        for name, seconds in metrics.phases.items():
+            samples.setdefault("phase_seconds", []).append((f'{labels},phase="{_label_value(name)}"', seconds))
+        for name, value in metrics.counters.items():
+            samples.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name, values in samples.items():
+        lines.append(f"# TYPE {METRIC_PREFIX}_{name} gauge")
+        lines.extend(f"{METRIC_PREFIX}_{name}{{{labels}}} {value}" for labels, value in values)
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path: str, all_metrics: list):
+    """Atomically writes the metrics for node_exporter's textfile collector."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as file:
+        file.write(to_prometheus(all_metrics))
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+    logger.info("Metrics written to %s", path)
+
+
+def push_to_gateway(url: str, all_metrics: list, job: str = METRIC_PREFIX):
+    try:
+        response = requests.put(f"{url.rstrip('/')}/metrics/job/{job}", data=to_prometheus(all_metrics),
+                                headers={"Content-Type": "text/plain; version=0.0.4"}, timeout=30)
+    except Exception as e:
+        logger.info(e)
+        return
+    if response.status_code >= 300:
+        logger.info("Failed pushing metrics: %s", response.text)
@@ -0,0 +1,78 @@
+import json
+import logging
+import re
+
+# summary: counts only, chunk: one line per import chunk, full: complete request and response bodies
+LEVELS = ("summary", "chunk", "full")
+
+REDACTED = "***"
+SECRET_KEYS = {"accesstoken", "apikey", "api_key", "authorization", "authtoken", "ghost_key", "password",
+               "secret", "secretkey", "signature", "token", "x-mbx-apikey"}
+BEARER_PATTERN = re.compile(r"(Bearer\s+)[A-Za-z0-9\-_.~+/=]+", re.IGNORECASE)
+
+
+def enabled(configured: str, level: str) -> bool:
+    """Whether payloads of level are logged with the configured level."""
+    return LEVELS.index(configured) >= LEVELS.index(level)
+
+
+def redact(payload):
+    """Copy of payload with secret values masked, keys are matched case-insensitively."""
+    if isinstance(payload, dict):
+        return {key: REDACTED if str(key).lower() in SECRET_KEYS else redact(value) for key, value in payload.items()}
+    if isinstance(payload, (list, tuple)):
+        return [redact(value) for value in payload]
+    if isinstance(payload, str):
+        return redact_text(payload)
+    return payload
+
+
+def redact_text(text: str) -> str:
+    return BEARER_PATTERN.sub(r"\1" + REDACTED, text)
+
+
+class Lazy:
+    """Log argument only rendered when the record is actually emitted."""
+
+    def __init__(self, render, *args):
+        self.render = render
+        self.args = args
+
+    def __str__(self) -> str:
+        return self.render(*self.args)
+
+
+def _dump(payload, indent) -> str:
+    if callable(payload):
+        payload = payload()
+    return json.dumps(redact(payload), indent=indent, default=str)
+
+
+def lazy_json(payload, indent: int = None) -> Lazy:
+    return Lazy(_dump, payload, indent)
+
+
+def lazy_text(text: str) -> Lazy:
+    return Lazy(redact_text, text)
+
+
+def _describe_acts(acts) -> str:
+    if not acts:
+        return "0 activities"
+    dates = [act.get("date", "") for act in acts]
+    symbols = sorted({act.get("symbol", "") for act in acts})
+    shown = ", ".join(symbols[:5]) + (f" and {len(symbols) - 5} more" if len(symbols) > 5 else "")
+    return f"{len(acts)} activities from {min(dates)[:10]} to {max(dates)[:10]} ({shown})"
+
+
+def describe_acts(acts) -> Lazy:
+    return Lazy(_describe_acts, acts)
+
+
+def log_payload(logger: logging.Logger, configured: str, level: str, msg: str, payload, indent: int = None):
+    """
+    Logs msg with payload as its only argument when the configured payload level and the logger
+    allow it. payload may be a callable, it is then only called when the record is emitted.
+    """
+    if enabled(configured, level) and logger.isEnabledFor(logging.INFO):
+        logger.info(msg, lazy_json(payload, indent))
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+from typing import Optional
+
+from activity import Activity
+
+logger = logging.getLogger(__name__)
+
+PLAN_VERSION = 1
+
+
+def plan_path(plan_dir: str, ghost_host: str, account_name: str, broker_account: str = "") -> str:
+    """
+    Where the plan of one broker account synced into one Ghostfolio account is kept, PLAN and
+    APPLY of the same accounts agree on it. Broker accounts sharing a Ghostfolio account get
+    a plan each.
+    """
+    host = hashlib.sha256(ghost_host.rstrip("/").encode("utf-8")).hexdigest()[:8]
+    name = "-".join(part for part in (file_part(account_name), file_part(broker_account)) if part) or "account"
+    return os.path.join(plan_dir, f"{name}-{host}.ndjson")
+
+
+def file_part(value: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "-", value or "").strip("-")
+
+
+class SyncPlan:
+    """
+    The writes a sync would make: cash balances and activities to import into one account.
+    Saved as NDJSON, a header line followed by one line per cash balance and per activity,
+    so large plans are written and read without holding a second copy as one JSON document.
+    """
+
+    def __init__(self, operation: str, ghost_host: str, account_name: str, account_id: Optional[str],
+                 date_range: Optional[str], cash: dict, activities: list, created_at: float = None,
+                 currency: str = ""):
+        self.operation = operation
+        self.ghost_host = ghost_host
+        self.account_name = account_name
+        # None when the account doesn't exist yet, it is created on apply
+        self.account_id = account_id
+        self.date_range = date_range
+        self.cash = cash
+        # Currency of the account, cash in other currencies goes to accounts of their own
+        self.currency = currency
+        self.activities = activities
+        self.created_at = created_at if created_at is not None else time.time()
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        header = {"kind": "plan", "version": PLAN_VERSION, "operation": self.operation,
+                  "ghostHost": self.ghost_host, "accountName": self.account_name, "accountId": self.account_id,
+                  "dateRange": self.date_range, "createdAt": self.created_at,
+                  "currency": self.currency}
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as file:
+                file.write(json.dumps(header) + "\n")
+                for currency, balance in self.cash.items():
+                    file.write(json.dumps({"kind": "cash", "currency": currency, "balance": balance}) + "\n")
+                for act in self.activities:
+                    line = dict(act.to_import(), kind="activity", figi=act.figi, brokerSymbol=act.broker_symbol)
+                    file.write(json.dumps(line) + "\n")
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        logger.info("Planned %s activities and %s cash updates into %s", len(self.activities), len(self.cash), path)
+
+    @classmethod
+    def load(cls, path: str) -> "SyncPlan":
+        cash = {}
+        activities = []
+        with open(path, "r") as file:
+            header = json.loads(file.readline())
+            if header.get("kind") != "plan" or header.get("version") != PLAN_VERSION:
+                raise Exception(f"{path} is not a version {PLAN_VERSION} sync plan")
+            for line in file:
+                record = json.loads(line)
+                if record["kind"] == "cash":
+                    cash[record["currency"]] = record["balance"]
+                elif record["kind"] == "activity":
+                    activities.append(Activity.from_import(record))
+        return cls(header["operation"], header["ghostHost"], header["accountName"], header["accountId"],
+                   header["dateRange"], cash, activities, header["createdAt"], header.get("currency", ""))
+
+    @staticmethod
+    def mark_applied(path: str):
+        """Applied plans are kept for reference but never applied twice."""
+        os.replace(path, f"{path}.applied")
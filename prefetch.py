@@ -0,0 +1,100 @@
+import logging
+import threading
+from datetime import date
+from typing import Iterable, Optional
+
+from ghostfolio_client import GhostfolioClient, range_start_dates
+
+logger = logging.getLogger(__name__)
+
+
+def range_covers(fetched: Optional[str], wanted: Optional[str], today: date = None) -> bool:
+    """Whether activities fetched for range `fetched` hold everything in `wanted`, None being the whole history."""
+    if fetched is None:
+        return True
+    if wanted is None:
+        return False
+    starts = dict(range_start_dates(today or date.today()))
+    if fetched not in starts or wanted not in starts:
+        return fetched == wanted
+    return starts[fetched] <= starts[wanted]
+
+
+class GhostfolioPrefetch:
+    """
+    Accounts and activities of one Ghostfolio user, shared by every operation of the run
+    using the same host and credentials. Accounts are listed once. The first activity fetch
+    asks for every target account at once and each operation is handed its own partition.
+    An operation needing a wider range than was fetched refetches the partitions nobody
+    took yet with that range. A partition is handed out once and dropped as soon as its
+    account is written to, so a later operation fetches what the writes left behind.
+    """
+
+    def __init__(self, client: GhostfolioClient, account_names: Iterable[str], whole_history: bool = False):
+        self.client = client
+        self.account_names = set(account_names)
+        self._lock = threading.Lock()
+        self._accounts = None
+        self._activities = None
+        # None is the whole history, asked for up front when an operation of the run needs it anyway
+        self._range = None
+        self._whole_history = whole_history
+        # Accounts whose partition was handed out or written to
+        self._taken = set()
+
+    def accounts(self) -> list:
+        with self._lock:
+            return list(self._list_accounts())
+
+    def add_account(self, account: dict):
+        with self._lock:
+            if self._accounts is not None:
+                self._accounts.append(account)
+
+    def activities(self, account_id: str, range: Optional[str] = None) -> Optional[list]:
+        """The prefetched activities of account_id, None when they have to be fetched separately."""
+        with self._lock:
+            if account_id in self._taken:
+                return None
+            if self._activities is None or not range_covers(self._range, range):
+                if self._activities is None and self._whole_history:
+                    range = None
+                account_ids = [account["id"] for account in self._list_accounts()
+                               if account["name"] in self.account_names and account["id"] not in self._taken]
+                if account_id not in account_ids:
+                    account_ids.append(account_id)
+                self._activities = self._fetch_activities(account_ids, range)
+                self._range = range
+            self._taken.add(account_id)
+            return self._activities.pop(account_id, None)
+
+    def discard(self, account_id: str):
+        """Drops the partition of account_id, which is about to be written to."""
+        with self._lock:
+            self._taken.add(account_id)
+            if self._activities is not None:
+                self._activities.pop(account_id, None)
+
+    def _list_accounts(self) -> list:
+        if self._accounts is None:
+            logger.info("Listing Ghostfolio accounts")
+            response = self.client.get("/api/v1/account")
+            if response.status_code != 200:
+                raise Exception(response)
+            self._accounts = response.json()["accounts"]
+        return self._accounts
+
+    def _fetch_activities(self, account_ids: list, range: Optional[str]) -> dict:
+        logger.info("Fetching activities of %s accounts for range %s", len(account_ids), range or "max")
+        activities = {account_id: [] for account_id in account_ids}
+        count = 0
+        try:
+            for page in self.client.activity_pages({"accounts": ",".join(account_ids), "range": range}):
+                for act in page:
+                    activities.setdefault(act["accountId"], []).append(act)
+                count += len(page)
+        except Exception as e:
+            logger.info(e)
+            return {}
+        logger.info("Prefetched %s activities", count)
+        return activities
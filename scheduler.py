@@ -0,0 +1,80 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    def __init__(self, name: str, payload, interval: float):
+        self.name = name
+        self.payload = payload
+        self.interval = interval
+        self.next_run = 0.0
+        self.running = False
+        self.queued = False
+
+
+class Scheduler:
+    """
+    Runs every job on its own interval, plus up to `jitter` random seconds so jobs sharing an
+    interval don't hit the same hosts at once. A job coming due while its previous run is
+    still going is queued once and started as soon as that run finishes, never dropped.
+    """
+
+    def __init__(self, run_job: Callable, max_workers: int = 1, jitter: float = 0.0):
+        self.run_job = run_job
+        self.max_workers = max_workers
+        self.jitter = jitter
+        self.jobs: List[Job] = []
+        self._condition = threading.Condition()
+        self._stopping = False
+
+    def add(self, name: str, payload, interval: float):
+        self.jobs.append(Job(name, payload, interval))
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+
+    def _delay(self, interval: float) -> float:
+        return interval + random.uniform(0, self.jitter)
+
+    def run_forever(self):
+        start = time.monotonic()
+        for job in self.jobs:
+            # First runs are spread over the jitter window as well
+            job.next_run = start + random.uniform(0, self.jitter)
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="account") as executor:
+            with self._condition:
+                while not self._stopping:
+                    now = time.monotonic()
+                    for job in self.jobs:
+                        if job.next_run > now:
+                            continue
+                        job.next_run = now + self._delay(job.interval)
+                        if job.running:
+                            logger.info("%s is still running, queueing its next run", job.name)
+                            job.queued = True
+                        else:
+                            self._submit(executor, job)
+                    timeout = min(job.next_run for job in self.jobs) - time.monotonic()
+                    self._condition.wait(max(timeout, 0))
+            logger.info("Stopping, waiting for the running jobs to finish")
+
+    def _submit(self, executor: ThreadPoolExecutor, job: Job):
+        job.running = True
+        future = executor.submit(self.run_job, job.payload)
+        future.add_done_callback(lambda _: self._finished(executor, job))
+
+    def _finished(self, executor: ThreadPoolExecutor, job: Job):
+        with self._condition:
+            job.running = False
+            if job.queued and not self._stopping:
+                job.queued = False
+                self._submit(executor, job)
+            self._condition.notify_all()
@@ -0,0 +1,240 @@
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+TRADE_ID_PATTERN = re.compile(r"tradeID=(\d+)")
+
+STATE_DB = "ghostfolio-sync.sqlite"
+
+
+def extract_trade_id(comment: Optional[str]) -> Optional[str]:
+    if not comment:
+        return None
+    match = TRADE_ID_PATTERN.search(comment)
+    return match.group(1) if match else None
+
+
+def symbol_trade_id(symbol: str, trade_id: str) -> str:
+    """Trade id unique across symbols, for brokers like Binance numbering the trades of every symbol apart."""
+    return f"{symbol}:{trade_id}"
+
+
+def trade_ids_from_acts(acts: Iterable[dict], per_symbol: bool = False) -> set:
+    """Trade ids of activities returned by Ghostfolio, scoped by their symbol when per_symbol is set."""
+    trade_ids = set()
+    for act in acts:
+        trade_id = extract_trade_id(act.get("comment"))
+        if trade_id is not None:
+            if per_symbol:
+                trade_id = symbol_trade_id((act.get("SymbolProfile") or {}).get("symbol") or act.get("symbol", ""),
+                                           trade_id)
+            trade_ids.add(trade_id)
+    return trade_ids
+
+
+@contextmanager
+def open_state_db(state_dir: str) -> Iterator[sqlite3.Connection]:
+    """Connection to the shared state database, committed and closed on exit."""
+    os.makedirs(state_dir, exist_ok=True)
+    path = os.path.join(state_dir, STATE_DB)
+    if not os.path.exists(path):
+        # May hold bearer tokens, SQLite gives its WAL files the same mode
+        os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+    connection = sqlite3.connect(path, timeout=30)
+    try:
+        connection.execute("PRAGMA journal_mode=WAL")
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def checksum_ids(trade_ids: Iterable[str]) -> str:
+    return hashlib.sha256("\n".join(sorted(trade_ids)).encode("utf-8")).hexdigest()
+
+
+class TradeLedger:
+    """
+    Trade IDs already imported into one Ghostfolio account.
+    A checksum over the stored IDs is kept next to them, a missing or mismatching
+    checksum means the ledger can't be trusted and has to be rebuilt from Ghostfolio.
+    """
+
+    def __init__(self, state_dir: str, ghost_host: str, account_id: str):
+        self.state_dir = state_dir
+        self.scope = f"{ghost_host.rstrip('/')}|{account_id}"
+        with open_state_db(state_dir) as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS synced_trades "
+                               "(scope TEXT NOT NULL, trade_id TEXT NOT NULL, PRIMARY KEY (scope, trade_id))")
+            connection.execute("CREATE TABLE IF NOT EXISTS ledger_meta "
+                               "(scope TEXT PRIMARY KEY, checksum TEXT NOT NULL, updated_at REAL NOT NULL)")
+
+    def load(self) -> Optional[set]:
+        with open_state_db(self.state_dir) as connection:
+            meta = connection.execute("SELECT checksum FROM ledger_meta WHERE scope = ?", (self.scope,)).fetchone()
+            if meta is None:
+                logger.info("No ledger found for %s", self.scope)
+                return None
+            trade_ids = {row[0] for row in
+                         connection.execute("SELECT trade_id FROM synced_trades WHERE scope = ?", (self.scope,))}
+        if checksum_ids(trade_ids) != meta[0]:
+            logger.warning("Ledger checksum mismatch for %s, it will be rebuilt", self.scope)
+            return None
+        logger.info("Loaded %s synced trade ids from ledger", len(trade_ids))
+        return trade_ids
+
+    def rebuild(self, trade_ids: set):
+        with open_state_db(self.state_dir) as connection:
+            connection.execute("DELETE FROM synced_trades WHERE scope = ?", (self.scope,))
+            self._write(connection, trade_ids, trade_ids)
+        logger.info("Rebuilt ledger with %s synced trade ids", len(trade_ids))
+
+    def add(self, trade_ids: set):
+        if not trade_ids:
+            return
+        with open_state_db(self.state_dir) as connection:
+            stored_ids = {row[0] for row in
+                          connection.execute("SELECT trade_id FROM synced_trades WHERE scope = ?", (self.scope,))}
+            self._write(connection, trade_ids, stored_ids | trade_ids)
+
+    def remove(self, trade_ids: set):
+        if not trade_ids:
+            return
+        with open_state_db(self.state_dir) as connection:
+            connection.executemany("DELETE FROM synced_trades WHERE scope = ? AND trade_id = ?",
+                                   ((self.scope, trade_id) for trade_id in trade_ids))
+            stored_ids = {row[0] for row in
+                          connection.execute("SELECT trade_id FROM synced_trades WHERE scope = ?", (self.scope,))}
+            self._write(connection, set(), stored_ids)
+
+    def clear(self):
+        with open_state_db(self.state_dir) as connection:
+            connection.execute("DELETE FROM synced_trades WHERE scope = ?", (self.scope,))
+            connection.execute("DELETE FROM ledger_meta WHERE scope = ?", (self.scope,))
+        logger.info("Cleared ledger for %s", self.scope)
+
+    def _write(self, connection: sqlite3.Connection, new_ids: set, all_ids: set):
+        connection.executemany("INSERT OR IGNORE INTO synced_trades (scope, trade_id) VALUES (?, ?)",
+                               ((self.scope, trade_id) for trade_id in new_ids))
+        connection.execute("INSERT OR REPLACE INTO ledger_meta (scope, checksum, updated_at) VALUES (?, ?, ?)",
+                           (self.scope, checksum_ids(all_ids), time.time()))
+
+
+class TradeCursorStore:
+    """Last trade id seen per symbol, so only newer trades are requested from the broker."""
+
+    def __init__(self, state_dir: str, ghost_host: str, account_id: str):
+        self.state_dir = state_dir
+        self.scope = f"{ghost_host.rstrip('/')}|{account_id}"
+        with open_state_db(state_dir) as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS trade_cursors "
+                               "(scope TEXT NOT NULL, symbol TEXT NOT NULL, last_id INTEGER NOT NULL, "
+                               "PRIMARY KEY (scope, symbol))")
+
+    def load(self) -> dict:
+        with open_state_db(self.state_dir) as connection:
+            return {symbol: last_id for symbol, last_id in
+                    connection.execute("SELECT symbol, last_id FROM trade_cursors WHERE scope = ?", (self.scope,))}
+
+    def save(self, cursors: dict):
+        if not cursors:
+            return
+        with open_state_db(self.state_dir) as connection:
+            connection.executemany("INSERT OR REPLACE INTO trade_cursors (scope, symbol, last_id) VALUES (?, ?, ?)",
+                                   ((self.scope, symbol, last_id) for symbol, last_id in cursors.items()))
+        logger.info("Saved trade cursors for %s symbols", len(cursors))
+
+    def clear(self):
+        with open_state_db(self.state_dir) as connection:
+            connection.execute("DELETE FROM trade_cursors WHERE scope = ?", (self.scope,))
+        logger.info("Cleared trade cursors for %s", self.scope)
+
+
+class TokenStore:
+    """Ghostfolio bearer tokens by host and a hash of the key they were fetched with."""
+
+    def __init__(self, state_dir: str):
+        self.state_dir = state_dir
+        with open_state_db(state_dir) as connection:
+            # Databases created before they were private
+            os.chmod(os.path.join(state_dir, STATE_DB), 0o600)
+            connection.execute("CREATE TABLE IF NOT EXISTS ghost_tokens "
+                               "(scope TEXT PRIMARY KEY, token TEXT NOT NULL, expires_at REAL)")
+
+    @staticmethod
+    def scope(ghost_host: str, ghost_key: str) -> str:
+        return f"{ghost_host.rstrip('/')}|{hashlib.sha256(ghost_key.encode('utf-8')).hexdigest()}"
+
+    def load(self, ghost_host: str, ghost_key: str) -> Optional[tuple]:
+        with open_state_db(self.state_dir) as connection:
+            return connection.execute("SELECT token, expires_at FROM ghost_tokens WHERE scope = ?",
+                                      (self.scope(ghost_host, ghost_key),)).fetchone()
+
+    def save(self, ghost_host: str, ghost_key: str, token: str, expires_at: Optional[float]):
+        with open_state_db(self.state_dir) as connection:
+            connection.execute("INSERT OR REPLACE INTO ghost_tokens (scope, token, expires_at) VALUES (?, ?, ?)",
+                               (self.scope(ghost_host, ghost_key), token, expires_at))
+
+    def delete(self, ghost_host: str, ghost_key: str):
+        with open_state_db(self.state_dir) as connection:
+            connection.execute("DELETE FROM ghost_tokens WHERE scope = ?", (self.scope(ghost_host, ghost_key),))
+
+
+class SymbolCache:
+    """Symbols one Ghostfolio host accepted or rejected on import, with the time it last did."""
+
+    def __init__(self, state_dir: str, ghost_host: str):
+        self.state_dir = state_dir
+        self.scope = ghost_host.rstrip("/")
+        with open_state_db(state_dir) as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS symbol_status "
+                               "(scope TEXT NOT NULL, symbol TEXT NOT NULL, ok INTEGER NOT NULL, "
+                               "checked_at REAL NOT NULL, PRIMARY KEY (scope, symbol))")
+
+    def load(self) -> dict:
+        with open_state_db(self.state_dir) as connection:
+            return {symbol: (bool(ok), checked_at) for symbol, ok, checked_at in
+                    connection.execute("SELECT symbol, ok, checked_at FROM symbol_status WHERE scope = ?",
+                                       (self.scope,))}
+
+    def save(self, ok_symbols: set, bad_symbols: set):
+        if not ok_symbols and not bad_symbols:
+            return
+        now = time.time()
+        rows = [(self.scope, symbol, 1, now) for symbol in ok_symbols]
+        rows += [(self.scope, symbol, 0, now) for symbol in bad_symbols]
+        with open_state_db(self.state_dir) as connection:
+            connection.executemany("INSERT OR REPLACE INTO symbol_status (scope, symbol, ok, checked_at) "
+                                   "VALUES (?, ?, ?, ?)", rows)
+
+
+class ExchangeSymbolCache:
+    """Symbols listed by one Binance API, with the time they were fetched."""
+
+    def __init__(self, state_dir: str, base_url: str):
+        self.state_dir = state_dir
+        self.scope = base_url.rstrip("/")
+        with open_state_db(state_dir) as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS exchange_symbols "
+                               "(scope TEXT PRIMARY KEY, symbols TEXT NOT NULL, fetched_at REAL NOT NULL)")
+
+    def load(self) -> Optional[tuple]:
+        """(symbols, fetched_at), None when they were never fetched."""
+        with open_state_db(self.state_dir) as connection:
+            row = connection.execute("SELECT symbols, fetched_at FROM exchange_symbols WHERE scope = ?",
+                                     (self.scope,)).fetchone()
+        if row is None:
+            return None
+        return set(row[0].split(",")) - {""}, row[1]
+
+    def save(self, symbols: set, fetched_at: float):
+        with open_state_db(self.state_dir) as connection:
+            connection.execute("INSERT OR REPLACE INTO exchange_symbols (scope, symbols, fetched_at) VALUES (?, ?, ?)",
+                               (self.scope, ",".join(sorted(symbols)), fetched_at))
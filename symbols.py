@@ -0,0 +1,137 @@
+import logging
+import os
+import re
+import threading
+import time
+from typing import Iterable, Optional
+
+import yaml
+
+from state import SymbolCache
+
+logger = logging.getLogger(__name__)
+
+# Applied after the rules of mapping.yaml, keep the behaviour the syncs had before the rules existed
+DEFAULT_RULES = {
+    "binance": [(r"^(?P<base>.+)USDT$", r"\g<base>USD")],
+}
+
+_mappings = {}
+_mappings_lock = threading.Lock()
+
+
+class CompiledMapping:
+    """Exact mappings and pattern rules of one broker, broker entries take precedence over shared ones."""
+
+    def __init__(self, config: dict, broker: str):
+        section = config.get(broker) or {}
+        self.exact = dict(config.get("symbol_mapping") or {})
+        self.exact.update(section.get("symbol_mapping") or {})
+        self.rules = [(re.compile(rule["pattern"]), rule["replace"]) for rule in section.get("rules") or []]
+        self.rules += [(re.compile(pattern), replace) for pattern, replace in DEFAULT_RULES.get(broker, [])]
+
+    def map(self, symbol: str) -> str:
+        mapped = self.exact.get(symbol)
+        if mapped is not None:
+            return mapped
+        for pattern, replace in self.rules:
+            if pattern.match(symbol):
+                return pattern.sub(replace, symbol)
+        return symbol
+
+
+def load_mapping(mapping_file: str, broker: str) -> CompiledMapping:
+    """mapping_file compiled for broker, parsed again only when the file changes."""
+    try:
+        modified = os.path.getmtime(mapping_file)
+    except OSError:
+        modified = None
+    with _mappings_lock:
+        cached = _mappings.get((mapping_file, broker))
+        if cached is not None and cached[0] == modified:
+            return cached[1]
+        config = {}
+        if modified is not None:
+            with open(mapping_file, "r") as file:
+                config = yaml.safe_load(file) or {}
+        else:
+            logger.info("No symbol mapping file %s", mapping_file)
+        mapping = CompiledMapping(config, broker)
+        _mappings[(mapping_file, broker)] = (modified, mapping)
+        return mapping
+
+
+class SymbolResolver:
+    """
+    Maps broker symbols to Ghostfolio ones and remembers, per Ghostfolio host, which of them
+    Ghostfolio accepted or rejected on import. Activities of rejected symbols are held back
+    until retry_bad_after seconds have passed instead of failing import chunks.
+    """
+
+    def __init__(self, mapping_file: str, broker: str, ghost_host: str = "", state_dir: str = "",
+                 retry_bad_after: float = 7 * 24 * 3600):
+        self.mapping_file = mapping_file
+        self.broker = broker
+        self.mapping = load_mapping(mapping_file, broker)
+        self.retry_bad_after = retry_bad_after
+        self.cache = SymbolCache(state_dir, ghost_host) if state_dir else None
+        self._resolved = {}
+        self._statuses: Optional[dict] = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Picks up changes to the mapping file, called at the start of every run."""
+        mapping = load_mapping(self.mapping_file, self.broker)
+        if mapping is not self.mapping:
+            logger.info("Symbol mapping %s changed, reloaded it", self.mapping_file)
+            self.mapping = mapping
+            self._resolved = {}
+
+    def resolve(self, symbol: str) -> str:
+        resolved = self._resolved.get(symbol)
+        if resolved is None:
+            resolved = self.mapping.map(symbol)
+            if resolved != symbol:
+                logger.info("Transformed symbol %s into %s", symbol, resolved)
+            self._resolved[symbol] = resolved
+        return resolved
+
+    def statuses(self) -> dict:
+        with self._lock:
+            if self._statuses is None:
+                self._statuses = self.cache.load() if self.cache is not None else {}
+            return self._statuses
+
+    def is_bad(self, symbol: str) -> bool:
+        status = self.statuses().get(symbol)
+        return (status is not None and not status[0]
+                and time.time() - status[1] < self.retry_bad_after)
+
+    def split_known_bad(self, acts: list) -> tuple:
+        """acts split into those to import and those whose symbol Ghostfolio rejected recently."""
+        good, bad = [], []
+        for act in acts:
+            (bad if self.is_bad(act.symbol) else good).append(act)
+        if bad:
+            logger.warning("Holding back %s activities of symbols Ghostfolio rejected before: %s",
+                           len(bad), ", ".join(sorted({act.symbol for act in bad})))
+        return good, bad
+
+    def record(self, imported: Iterable, rejected: Iterable):
+        """
+        Remembers the outcome of an import. A symbol is only bad when Ghostfolio rejected its
+        activities one by one and none of them made it, not when the import failed as a whole.
+        """
+        ok_symbols = {act.symbol for act in imported}
+        statuses = self.statuses()
+        bad_symbols = {act.symbol for act in rejected} - ok_symbols
+        # A symbol that imported fine before failed for another reason
+        bad_symbols = {symbol for symbol in bad_symbols if not statuses.get(symbol, (False,))[0]}
+        if bad_symbols:
+            logger.warning("Ghostfolio rejected symbols %s", ", ".join(sorted(bad_symbols)))
+        now = time.time()
+        with self._lock:
+            statuses.update({symbol: (True, now) for symbol in ok_symbols})
+            statuses.update({symbol: (False, now) for symbol in bad_symbols})
+        if self.cache is not None:
+            self.cache.save(ok_symbols, bad_symbols)
@@ -0,0 +1,458 @@
+import asyncio
+import contextvars
+import logging
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterator, Optional
+
+import metrics
+import payload_log
+from activity import activity_trade_id, get_new_activities, ghostfolio_match_key, trade_ids
+from activity_io import batches, read_activities
+from ghostfolio_client import GhostfolioClient, date_range_for_acts, get_token
+from import_pipeline import ImportPipeline
+from plan import SyncPlan
+from prefetch import GhostfolioPrefetch
+from state import TradeCursorStore, TradeLedger, trade_ids_from_acts
+from symbols import SymbolResolver
+from sync_settings import SyncSettings
+
+logger = logging.getLogger(__name__)
+
+def balance_unchanged(account: Optional[dict], currency: str, balance: float, tolerance: float) -> bool:
+    """Whether account, as Ghostfolio last returned it, already holds balance in currency."""
+    if not account or account.get("currency") != currency:
+        return False
+    try:
+        return abs(float(account.get("balance")) - float(balance)) <= tolerance
+    except (TypeError, ValueError):
+        return False
+
+
+class BrokerSource(ABC):
+    """
+    The broker side of a sync. fetch reads what doesn't depend on the Ghostfolio account and
+    runs alongside the account lookup, activities then builds the trades of account_id.
+    Both block and are run in worker threads by the engine.
+    """
+    operation = "SYNC"
+    # Whether cash holds one balance per currency instead of the total of the account
+    cash_per_currency = False
+    # Pairs of (Ghostfolio symbol type, Activity attribute) an existing activity is matched on
+    symbol_matches = (("symbol", "symbol"),)
+    # Whether trade ids are only unique within a symbol, they are then compared along with it
+    trade_ids_per_symbol = False
+
+    def __init__(self, symbols: SymbolResolver):
+        self.symbols = symbols
+
+    def fetch(self) -> bool:
+        """False when the broker couldn't be read and there is nothing to sync."""
+        return True
+
+    def cash(self) -> dict:
+        return {}
+
+    @abstractmethod
+    def activities(self, account_id: str) -> list:
+        """The broker trades as Activity objects of account_id."""
+
+    def held_back(self, acts: list):
+        """Called with the activities left out of the plan because Ghostfolio rejected their symbol."""
+
+    def synced(self, account_id: str):
+        """Called once everything planned made it into Ghostfolio."""
+
+
+class GhostfolioSink:
+    """
+    One Ghostfolio account as the target of a sync: finding or creating it, its cash, its
+    activities and the ledger of the trades imported into it.
+    """
+
+    def __init__(self, ghost_host: str, ghost_key: str, ghost_token: str, account_name: str, currency: str,
+                 platform_id: str, state_dir: str = "", settings: SyncSettings = None):
+        self.settings = settings or SyncSettings()
+        self.client = GhostfolioClient(ghost_host, settings=self.settings)
+        if ghost_token == "" and ghost_key:
+            logger.info("No bearer token provided, using the access key")
+            ghost_token = get_token(ghost_host, ghost_key, self.settings)
+            # Renewed from the key when it expires or gets rejected
+            self.client.key = ghost_key
+        if not ghost_token:
+            logger.info("No bearer token provided, closing now")
+            raise Exception("No bearer token provided")
+        self.client.token = ghost_token
+        self.host = ghost_host
+        self.account_name = account_name
+        self.currency = currency
+        self.platform_id = platform_id
+        self.state_dir = state_dir
+        self.account_id: Optional[str] = None
+        # Ghostfolio accounts by name as last seen, their balance saves rewriting unchanged cash
+        self.accounts = {}
+        # Set by main.py when the run prefetched the accounts and activities of this Ghostfolio user
+        self.prefetch: Optional[GhostfolioPrefetch] = None
+
+    def get_all_accounts(self) -> list:
+        if self.prefetch is not None:
+            return self.prefetch.accounts()
+        logger.info("Finding all accounts")
+        try:
+            response = self.client.get("/api/v1/account")
+        except Exception as e:
+            logger.info(e)
+            return []
+        if response.status_code == 200:
+            return response.json()["accounts"]
+        raise Exception(response)
+
+    def find_account_id(self) -> str:
+        if self.account_id is not None:
+            return self.account_id
+        accounts = self.get_all_accounts()
+        logger.info("Found %s accounts", len(accounts))
+        payload_log.log_payload(logger, self.settings.log_payloads, "full", "Accounts: %s", accounts, indent=4)
+        self.accounts.update((account["name"], account) for account in accounts)
+        account = self.accounts.get(self.account_name)
+        if account is None:
+            return ""
+        logger.info("Ghostfolio account: %s", account["id"])
+        self.account_id = account["id"]
+        return self.account_id
+
+    def create_account(self, name: str = None, currency: str = None) -> str:
+        account = {
+            "balance": 0,
+            "currency": currency or self.currency,
+            "isExcluded": False,
+            "name": name or self.account_name,
+            "platformId": self.platform_id
+        }
+        logger.info("Creating account %s", account["name"])
+        try:
+            response = self.client.post("/api/v1/account", account)
+        except Exception as e:
+            logger.info(e)
+            return ""
+        if response.status_code == 201:
+            logger.info("Created account %s", response.json()["id"])
+            if self.prefetch is not None:
+                self.prefetch.add_account(response.json())
+            self.accounts[account["name"]] = response.json()
+            return response.json()["id"]
+        logger.info("Failed creating account: %s", response.text)
+        return ""
+
+    def create_or_get_account_id(self) -> str:
+        account_id = self.find_account_id()
+        if account_id != "":
+            return account_id
+        self.account_id = self.create_account() or None
+        return self.account_id or ""
+
+    def find_or_create_account(self, name: str, currency: str) -> str:
+        if name not in self.accounts:
+            self.accounts.update((account["name"], account) for account in self.get_all_accounts())
+        if name in self.accounts:
+            return self.accounts[name]["id"]
+        return self.create_account(name, currency)
+
+    def set_cash(self, account_id: str, cash: dict, per_currency: bool = False):
+        if not cash:
+            logger.info("No cash set, no cash retrieved")
+            return
+        for currency, amount in cash.items():
+            # A balance of another currency would change the currency of the account
+            if currency == self.currency or (not per_currency and len(cash) == 1):
+                self.update_cash(account_id, self.account_name, currency, amount)
+                continue
+            # Ghostfolio keeps one balance per account, cash in other currencies gets an account of its own
+            name = f"{self.account_name} ({currency})"
+            cash_account_id = self.find_or_create_account(name, currency)
+            if cash_account_id != "":
+                self.update_cash(cash_account_id, name, currency, amount)
+
+    def update_cash(self, account_id: str, name: str, currency: str, balance: float):
+        if balance_unchanged(self.accounts.get(name), currency, balance, self.settings.cash_tolerance):
+            logger.info("Cash for account %s unchanged at %s %s", account_id, balance, currency)
+            metrics.count("cash_updates_skipped")
+            return
+        account = {
+            "balance": balance,
+            "id": account_id,
+            "currency": currency,
+            "isExcluded": False,
+            "name": name,
+            "platformId": self.platform_id
+        }
+        logger.info("Updating cash for account %s: %s %s", account_id, balance, currency)
+        payload_log.log_payload(logger, self.settings.log_payloads, "full", "Cash update: %s", account)
+        try:
+            response = self.client.put(f"/api/v1/account/{account_id}", account)
+        except Exception as e:
+            logger.info(e)
+            return
+        if response.status_code == 200:
+            logger.info("Updated cash for account %s", account_id)
+            self.accounts[name] = account
+            metrics.count("cash_updates")
+        else:
+            logger.info("Failed to update cash: %s", response.text)
+
+    def get_activities(self, account_id: str = None, range: str = None, symbol: str = None) -> list:
+        if account_id is None:
+            account_id = self.create_or_get_account_id()
+        if self.prefetch is not None and symbol is None:
+            acts = self.prefetch.activities(account_id, range)
+            if acts is not None:
+                return acts
+        try:
+            response = self.client.get("/api/v1/order",
+                                       params={"accounts": account_id,
+                                               "range": range,  # https://github.com/ghostfolio/ghostfolio/blob/main/libs/common/src/lib/types/date-range.type.ts
+                                               "symbol": symbol})
+        except Exception as e:
+            logger.info(e)
+            return []
+        if response.status_code == 200:
+            return response.json()["activities"]
+        return []
+
+    def iter_activities(self, account_id: str, range: str = None) -> Iterator[dict]:
+        """Activities of account_id read page by page, for accounts too large to hold at once."""
+        for page in self.client.activity_pages({"accounts": account_id, "range": range}):
+            yield from page
+
+    def discard_prefetched(self, account_id: Optional[str]):
+        """Called before writing to account_id, its prefetched activities would be stale afterwards."""
+        if self.prefetch is not None and account_id:
+            self.prefetch.discard(account_id)
+
+    def post_import_chunk(self, acts) -> int:
+        for account_id in {act.account_id for act in acts}:
+            self.discard_prefetched(account_id)
+        payload = [act.to_import() for act in acts]
+        if payload_log.enabled(self.settings.log_payloads, "chunk"):
+            logger.info("Adding %s", payload_log.describe_acts(payload))
+        payload_log.log_payload(logger, self.settings.log_payloads, "full", "Adding activities:\n%s", payload,
+                                indent=4)
+        response = self.client.post("/api/v1/import", {"activities": payload})
+        if response.status_code == 201:
+            payload_log.log_payload(logger, self.settings.log_payloads, "full", "Added activities. Response:\n%s",
+                                    response.json, indent=4)
+        else:
+            logger.info("Failed to create: %s", payload_log.lazy_text(response.text))
+        return response.status_code
+
+    def delete_act(self, act_id: str) -> bool:
+        try:
+            response = self.client.delete(f"/api/v1/order/{act_id}")
+        except Exception as e:
+            logger.info(e)
+            return False
+        return response.status_code == 200
+
+    def delete_acts(self, act_ids: list) -> set:
+        """Deletes act_ids, up to settings.max_deletes_in_flight at a time, returns the ones deleted."""
+        if not act_ids:
+            return set()
+        logger.info("Deleting %s activities", len(act_ids))
+        self.discard_prefetched(self.account_id)
+        with ThreadPoolExecutor(max_workers=max(1, self.settings.max_deletes_in_flight),
+                                thread_name_prefix="delete") as executor:
+            futures = {executor.submit(contextvars.copy_context().run, self.delete_act, act_id): act_id
+                       for act_id in act_ids}
+            return {futures[future] for future in as_completed(futures) if future.result()}
+
+    def delete_all_acts(self) -> bool:
+        if not self.get_activities():
+            logger.info("No activities to delete")
+            return True
+        account_id = self.create_or_get_account_id()
+        self.discard_prefetched(account_id)
+        try:
+            response = self.client.delete("/api/v1/order", params={"accounts": account_id})
+        except Exception as e:
+            logger.info(e)
+            return False
+        if response.status_code == 200 and self.state_dir:
+            # Brokers read from their cursors would otherwise never hand the deleted trades out again
+            self.get_ledger(account_id).clear()
+            TradeCursorStore(self.state_dir, self.host, account_id).clear()
+        return response.status_code == 200
+
+    def get_ledger(self, account_id: str) -> Optional[TradeLedger]:
+        if not self.state_dir:
+            return None
+        return TradeLedger(self.state_dir, self.host, account_id)
+
+
+class SyncEngine:
+    """
+    Plans and applies the sync of one broker account into one Ghostfolio account. Blocking
+    calls run in worker threads, so the broker and Ghostfolio reads of a sync overlap and any
+    number of accounts can be driven from one event loop.
+    """
+
+    def __init__(self, source: BrokerSource, sink: GhostfolioSink):
+        self.source = source
+        self.sink = sink
+
+    async def sync(self) -> bool:
+        plan = await self.plan()
+        if plan is None:
+            return False
+        return await self.apply(plan)
+
+    async def plan(self, dry_run: bool = False) -> Optional[SyncPlan]:
+        """
+        Reads the broker and Ghostfolio and works out the cash balances and activities to
+        write. A dry run neither creates the account nor touches the ledger.
+        """
+        self.source.symbols.refresh()
+        fetched, account_id = await asyncio.gather(asyncio.to_thread(self.source.fetch),
+                                                   asyncio.to_thread(self._timed, "ghostfolio_account",
+                                                                     self.sink.find_account_id))
+        if not fetched:
+            return None
+        if account_id == "" and not dry_run:
+            # Created only now, the broker may have told the account currency
+            with metrics.phase("ghostfolio_account"):
+                account_id = await asyncio.to_thread(self.sink.create_account)
+            if account_id == "":
+                logger.info("Failed to retrieve account ID closing now")
+                return None
+            self.sink.account_id = account_id
+        cash = self.source.cash()
+        activities = await asyncio.to_thread(self.source.activities, account_id)
+
+        plan = SyncPlan(self.source.operation, self.sink.host, self.sink.account_name, account_id or None, None,
+                        cash, [], currency=self.sink.currency)
+        metrics.count("activities_source", len(activities))
+        if not activities:
+            logger.info("Nothing new to sync")
+            return plan
+        ledger = self.sink.get_ledger(account_id) if account_id else None
+        synced_ids = await asyncio.to_thread(ledger.load) if ledger is not None else None
+        per_symbol = self.source.trade_ids_per_symbol
+        report_ids = trade_ids(activities, per_symbol)
+        if synced_ids is not None:
+            activities = [act for act in activities if activity_trade_id(act, per_symbol) not in synced_ids]
+            metrics.count("activities_skipped_by_ledger", len(report_ids) - len(activities))
+            logger.info("%s trades not found in the ledger", len(activities))
+            if len(activities) == 0:
+                logger.info("Nothing new to sync")
+                return plan
+
+        # Only the part of the history the incoming trades can collide with is fetched and diffed
+        date_range = date_range_for_acts(activities)
+        plan.date_range = date_range
+        existing_acts = []
+        if account_id:
+            logger.info("Fetching Ghostfolio activities for range %s", date_range or "max")
+            with metrics.phase("ghostfolio_fetch"):
+                existing_acts = await asyncio.to_thread(self.sink.get_activities, account_id, date_range)
+        metrics.count("activities_existing", len(existing_acts))
+        with metrics.phase("diff"):
+            diff = get_new_activities(existing_acts, activities, self.source.symbol_matches, per_symbol)
+        metrics.count("activities_new", len(diff))
+        if ledger is not None and not dry_run:
+            # Source trades outside the diff are synced too, even when Ghostfolio has no tradeID for them
+            synced = trade_ids_from_acts(existing_acts, per_symbol) | (report_ids - trade_ids(diff, per_symbol))
+            if date_range is None or synced_ids is None:
+                await asyncio.to_thread(ledger.rebuild, synced)
+            else:
+                # A windowed fetch only knows about recent activities, keep what the ledger had before
+                await asyncio.to_thread(ledger.add, synced)
+        plan.activities, held_back = self.source.symbols.split_known_bad(diff)
+        if held_back:
+            self.source.held_back(held_back)
+        return plan
+
+    async def apply(self, plan: SyncPlan, verify: bool = False) -> bool:
+        """
+        Writes a plan to Ghostfolio. With verify the activities already in Ghostfolio are
+        dropped first, for plans saved by an earlier run.
+        """
+        account_id = plan.account_id
+        if plan.currency:
+            self.sink.currency = plan.currency
+        if account_id is None:
+            with metrics.phase("ghostfolio_account"):
+                account_id = await asyncio.to_thread(self.sink.create_or_get_account_id)
+            if account_id == "":
+                logger.info("Failed to retrieve account ID closing now")
+                return False
+            plan.activities = [act.for_account(account_id) for act in plan.activities]
+        with metrics.phase("cash"):
+            await asyncio.to_thread(self.sink.set_cash, account_id, plan.cash,
+                                    self.source.cash_per_currency)
+        diff = plan.activities
+        if verify and diff:
+            with metrics.phase("ghostfolio_fetch"):
+                existing_acts = await asyncio.to_thread(self.sink.get_activities, account_id, plan.date_range)
+            with metrics.phase("diff"):
+                diff = get_new_activities(existing_acts, diff, self.source.symbol_matches,
+                                          self.source.trade_ids_per_symbol)
+            logger.info("%s of %s planned activities are not in Ghostfolio yet", len(diff), len(plan.activities))
+        if len(diff) == 0:
+            logger.info("Nothing new to sync")
+            await asyncio.to_thread(self.source.synced, account_id)
+            return True
+        with metrics.phase("import"):
+            imported = await asyncio.to_thread(self.import_acts, diff)
+        if not imported:
+            return False
+        ledger = self.sink.get_ledger(account_id)
+        if ledger is not None:
+            await asyncio.to_thread(ledger.add, trade_ids(diff, self.source.trade_ids_per_symbol))
+        await asyncio.to_thread(self.source.synced, account_id)
+        return True
+
+    def import_acts(self, bulk: list) -> bool:
+        settings = self.sink.settings
+        pipeline = ImportPipeline(self.sink.post_import_chunk, chunk_size=settings.import_chunk_size,
+                                  min_chunk_size=settings.import_min_chunk_size,
+                                  max_chunk_size=settings.import_max_chunk_size,
+                                  max_in_flight=settings.import_in_flight,
+                                  target_latency=settings.import_target_latency)
+        result = pipeline.run(sorted(bulk, key=lambda x: x.timestamp))
+        metrics.count("activities_imported", len(result.imported))
+        metrics.count("activities_failed", len(result.failed))
+        self.source.symbols.record(result.imported, result.rejected)
+        return result.ok
+
+    def import_file(self, path: str, fmt: Optional[str], batch_size: int) -> bool:
+        """
+        Streams an exported activity file into the account, batch_size activities at a time.
+        Activities the account already holds, or the file holds twice, are skipped so an
+        interrupted import can be run again.
+        """
+        account_id = self.sink.create_or_get_account_id()
+        if account_id == "":
+            logger.info("Failed to retrieve account ID closing now")
+            return False
+        known = {ghostfolio_match_key(act) for act in self.sink.iter_activities(account_id)}
+        ok = True
+        imported = skipped = 0
+        for batch in batches(read_activities(path, account_id, fmt), batch_size):
+            new_acts = []
+            for act in batch:
+                key = act.match_key(act.symbol)
+                if key in known:
+                    skipped += 1
+                    continue
+                known.add(key)
+                new_acts.append(act)
+            if new_acts:
+                ok = self.import_acts(new_acts) and ok
+                imported += len(new_acts)
+        metrics.count("activities_skipped_existing", skipped)
+        logger.info("Imported %s activities from %s, %s were already there", imported, path, skipped)
+        return ok
+
+    @staticmethod
+    def _timed(name: str, call):
+        with metrics.phase(name):
+            return call()
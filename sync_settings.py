@@ -0,0 +1,45 @@
+from payload_log import LEVELS
+
+
+class SyncSettings:
+    """
+    Tuning shared by the syncs of a run, built once by main.py from the environment and
+    handed to every sync, which passes it on to the client, pipeline and caches it uses.
+    The defaults are those of a run without any of the variables set.
+    """
+
+    def __init__(self, ghost_timeout: float = 30.0, ghost_retries: int = 3, ghost_backoff: float = 1.0,
+                 ghost_pool_size: int = 10, token_dir: str = "",
+                 import_chunk_size: int = 10, import_min_chunk_size: int = 1, import_max_chunk_size: int = 100,
+                 import_in_flight: int = 1, import_target_latency: float = 5.0,
+                 flex_cache_dir: str = "", flex_cache_ttl: float = 0, flex_replay: bool = False, flex_file: str = "",
+                 flex_processes: int = 0, log_payloads: str = "summary", symbol_retry_after: float = 7 * 24 * 3600,
+                 cash_tolerance: float = 0.01, max_deletes_in_flight: int = 4):
+        if log_payloads not in LEVELS:
+            raise ValueError(f"Unknown payload log level {log_payloads}, expected one of {', '.join(LEVELS)}")
+        # Ghostfolio requests, tokens are only kept on disk when token_dir is set
+        self.ghost_timeout = ghost_timeout
+        self.ghost_retries = ghost_retries
+        self.ghost_backoff = ghost_backoff
+        self.ghost_pool_size = ghost_pool_size
+        self.token_dir = token_dir
+        # Import chunks, see ImportPipeline
+        self.import_chunk_size = import_chunk_size
+        self.import_min_chunk_size = import_min_chunk_size
+        self.import_max_chunk_size = import_max_chunk_size
+        self.import_in_flight = import_in_flight
+        self.import_target_latency = import_target_latency
+        # Flex reports, see flex_cache.download_flex and flex_stream.parse_flex
+        self.flex_cache_dir = flex_cache_dir
+        self.flex_cache_ttl = flex_cache_ttl
+        self.flex_replay = flex_replay
+        self.flex_file = flex_file
+        self.flex_processes = flex_processes
+        # summary, chunk or full, see payload_log
+        self.log_payloads = log_payloads
+        # Seconds before a symbol Ghostfolio rejected is tried again
+        self.symbol_retry_after = symbol_retry_after
+        # Cash balances closer than this to the one in Ghostfolio are not written again
+        self.cash_tolerance = cash_tolerance
+        # Deletes sent at the same time when reconciling one account
+        self.max_deletes_in_flight = max_deletes_in_flight